@@ -6,38 +6,82 @@ Maintenance utilities for Remorph fingerprint database and system health.
 import json
 import os
 import argparse
-from datetime import datetime
-from typing import Dict, Any
+import shutil
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Tuple
 
 from src.config import FINGERPRINTS_PATH, OUTPUT_DIR
-from src.trace.attribution import AttributionIndex
+from src.trace.attribution import AttributionIndex, get_attribution_index
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
-def cleanup_old_outputs(days_old: int = 7):
-    """Remove output files older than specified days"""
+def _is_day_dir(name: str) -> bool:
+    """Whether name looks like a per-day output directory (YYYYMMDD)"""
+    return len(name) == 8 and name.isdigit()
+
+def cleanup_old_outputs(days_old: int = 7, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Remove outputs older than specified days.
+    Per-day (YYYYMMDD) output directories are removed whole; loose files by mtime.
+    With dry_run, only log what would be removed.
+    Returns (directories, files) removed, or that would be removed.
+    """
     import time
     
     if not os.path.exists(OUTPUT_DIR):
         logger.info("Output directory doesn't exist")
-        return
+        return 0, 0
     
     cutoff_time = time.time() - (days_old * 24 * 60 * 60)
+    cutoff_day = (datetime.now(timezone.utc) - timedelta(days=days_old)).strftime("%Y%m%d")
     removed_count = 0
+    removed_dirs = 0
+    
+    # scandir returns entry types with the listing, and stat() results are cached
+    # per entry; where supported, unlink relative to the directory fd (unlinkat)
+    dir_fd = None
+    if not dry_run and os.unlink in os.supports_dir_fd:
+        dir_fd = os.open(OUTPUT_DIR, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
     
-    for filename in os.listdir(OUTPUT_DIR):
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        if os.path.isfile(filepath):
-            if os.path.getmtime(filepath) < cutoff_time:
+    try:
+        with os.scandir(OUTPUT_DIR) as entries:
+            for entry in entries:
                 try:
-                    os.remove(filepath)
+                    if entry.is_dir(follow_symlinks=False):
+                        if _is_day_dir(entry.name) and entry.name < cutoff_day:
+                            if dry_run:
+                                logger.info(f"Would remove old output directory: {entry.name}")
+                            else:
+                                shutil.rmtree(entry.path)
+                            removed_dirs += 1
+                            logger.debug(f"Removed old output directory: {entry.name}")
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if entry.stat(follow_symlinks=False).st_mtime >= cutoff_time:
+                        continue
+                    if dry_run:
+                        logger.info(f"Would remove old file: {entry.name}")
+                        removed_count += 1
+                        continue
+                    if dir_fd is not None:
+                        os.unlink(entry.name, dir_fd=dir_fd)
+                    else:
+                        os.unlink(entry.path)
                     removed_count += 1
-                    logger.debug(f"Removed old file: {filename}")
+                    logger.debug(f"Removed old file: {entry.name}")
                 except Exception as e:
-                    logger.error(f"Failed to remove {filename}: {e}")
+                    logger.error(f"Failed to remove {entry.name}: {e}")
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
     
-    logger.info(f"Cleanup complete: removed {removed_count} files older than {days_old} days")
+    logger.info(
+        f"Cleanup complete: {'would remove' if dry_run else 'removed'} {removed_dirs} directories "
+        f"and {removed_count} files older than {days_old} days"
+    )
+    return removed_dirs, removed_count
 
 def backup_fingerprints():
     """Create backup of fingerprints database"""
@@ -49,7 +93,7 @@ def backup_fingerprints():
     backup_path = f"{FINGERPRINTS_PATH}.backup_{timestamp}"
     
     try:
-        import shutil
+        # copy2 already uses in-kernel copies (sendfile on Linux, fcopyfile on macOS)
         shutil.copy2(FINGERPRINTS_PATH, backup_path)
         logger.info(f"Fingerprints backed up to: {backup_path}")
         return backup_path
@@ -60,7 +104,7 @@ def backup_fingerprints():
 def validate_fingerprints():
     """Validate fingerprints database integrity"""
     try:
-        idx = AttributionIndex(FINGERPRINTS_PATH)
+        idx = get_attribution_index(FINGERPRINTS_PATH)
         stats = idx.get_family_stats()
         
         logger.info("Fingerprints validation:")
@@ -97,11 +141,12 @@ def main():
     parser = argparse.ArgumentParser(description="Remorph maintenance utilities")
     parser.add_argument("command", choices=["cleanup", "backup", "validate", "reset"])
     parser.add_argument("--days", type=int, default=7, help="Days for cleanup (default: 7)")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what cleanup would remove")
     
     args = parser.parse_args()
     
     if args.command == "cleanup":
-        cleanup_old_outputs(args.days)
+        cleanup_old_outputs(args.days, dry_run=args.dry_run)
     elif args.command == "backup":
         backup_fingerprints()
     elif args.command == "validate":
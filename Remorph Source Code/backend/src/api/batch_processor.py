@@ -1,31 +1,31 @@
 import asyncio
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
 from src.utils.logging import setup_logger
-from src.models.face_detector import face_detector
-from src.models.detector import HeuristicDetector, TorchDetector
-from src.config import WEIGHTS_PATH
+from src.api.routes.analyze import (
+    analysis_semaphore, get_face_detector, get_heuristic_detector, get_torch_detector
+)
 
 logger = setup_logger(__name__)
 
 class BatchProcessor:
     """Process multiple images concurrently"""
     
-    def __init__(self, max_workers: int = 4):
-        self.max_workers = max_workers
-        self.heuristic_detector = HeuristicDetector()
-        self.torch_detector = TorchDetector(WEIGHTS_PATH, device="cpu")
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self):
+        self.face_detector = get_face_detector()
+        self.heuristic_detector = get_heuristic_detector()
+        self.torch_detector = get_torch_detector()
     
     def _process_single_image(self, image_data: tuple) -> Dict[str, Any]:
         """Process a single image (runs in thread)"""
-        image_id, image = image_data
+        image_id, image, face = image_data
         
         try:
-            # Face detection
-            face_im, face_found, face_conf = face_detector.detect_largest_face(image)
+            # Face detection, unless it already ran batched for the whole request
+            if face is None:
+                face = self.face_detector.detect_largest_face(image)
+            face_im, face_found, face_conf = face
             
             # Heuristic analysis
             heuristic_result = self.heuristic_detector.analyze(face_im)
@@ -52,6 +52,11 @@ class BatchProcessor:
                 "error": str(e)
             }
     
+    async def _process_in_thread(self, image_data: tuple) -> Dict[str, Any]:
+        """Run a single image on a worker thread, sharing the global analysis limit"""
+        async with analysis_semaphore:
+            return await asyncio.to_thread(self._process_single_image, image_data)
+    
     async def process_batch(self, images: List[Image.Image]) -> List[Dict[str, Any]]:
         """Process multiple images concurrently"""
         if not images:
@@ -59,15 +64,17 @@ class BatchProcessor:
         
         logger.info(f"Starting batch processing of {len(images)} images")
         
+        # On GPU, detect faces for the whole batch in one pass per image size
+        faces: List[Optional[Tuple[Image.Image, bool, float]]] = [None] * len(images)
+        if self.face_detector.device == "cuda":
+            async with analysis_semaphore:
+                faces = await asyncio.to_thread(self.face_detector.detect_largest_faces, images)
+        
         # Assign IDs to images
-        image_data = [(str(uuid.uuid4())[:8], img) for img in images]
+        image_data = [(str(uuid.uuid4())[:8], img, face) for img, face in zip(images, faces)]
         
-        # Process in thread pool
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(self.executor, self._process_single_image, data)
-            for data in image_data
-        ]
+        # Process on worker threads, bounded by the shared analysis semaphore
+        tasks = [self._process_in_thread(data) for data in image_data]
         
         results = await asyncio.gather(*tasks, return_exceptions=True)
         
@@ -88,13 +95,6 @@ class BatchProcessor:
         logger.info(f"Batch processing complete: {successful}/{len(images)} successful")
         
         return processed_results
-    
-    def __del__(self):
-        """Cleanup thread pool"""
-        try:
-            self.executor.shutdown(wait=False)
-        except Exception:
-            pass
 
 # Global batch processor instance
 batch_processor = BatchProcessor()
\ No newline at end of file
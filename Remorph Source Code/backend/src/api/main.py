@@ -1,16 +1,38 @@
 import os
 from contextlib import asynccontextmanager
+import PIL
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 from src.api.routes import analyze, health
-from src.api.middleware import LoggingMiddleware, SecurityHeadersMiddleware
-from src.config import OUTPUT_DIR, validate_config
+from src.api.middleware import LoggingMiddleware, SecurityHeadersMiddleware, UploadSizeLimitMiddleware
+from src.config import OUTPUT_DIR, FINGERPRINTS_PATH, WEIGHTS_PATH, MAX_CONCURRENT_ANALYSES, validate_config
+from src.trace.attribution import flush_attribution_indexes, preload_file
+from src.utils.img import is_pillow_simd, libjpeg_turbo_version
+from src.utils.validation import max_request_bytes
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
+def _limit_library_threads():
+    """
+    Analyses already run in parallel worker threads, so keep OpenCV and Torch
+    single-threaded per call to avoid oversubscribing the CPU.
+    """
+    try:
+        import cv2
+        cv2.setNumThreads(1)
+    except Exception as e:
+        logger.warning(f"Could not limit OpenCV threads: {e}")
+    
+    try:
+        import torch
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+    except Exception as e:
+        logger.warning(f"Could not limit Torch threads: {e}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan events"""
@@ -29,10 +51,34 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.warning(f"Could not create output directory '{OUTPUT_DIR}' at startup: {e}")
         
+        # Prime the page cache for data files loaded below / on first request
+        for path in (FINGERPRINTS_PATH, WEIGHTS_PATH):
+            if preload_file(path):
+                logger.debug(f"Preloading {path}")
+        
+        # JPEG decode/re-encode dominates ingest and the ELA/quantization features
+        turbo = libjpeg_turbo_version()
+        if turbo:
+            logger.info(f"Pillow {PIL.__version__} using libjpeg-turbo {turbo}")
+        else:
+            logger.warning(f"Pillow {PIL.__version__} is not built with libjpeg-turbo; JPEG handling will be slower")
+        if not is_pillow_simd():
+            logger.info("Pillow-SIMD not installed; resizes use Pillow's generic kernels")
+        
+        if MAX_CONCURRENT_ANALYSES > 1:
+            _limit_library_threads()
+            logger.info(f"Library threads limited to 1 for {MAX_CONCURRENT_ANALYSES} concurrent analyses")
+        
         # Initialize face detector (singleton)
         from src.models.face_detector import face_detector
         logger.info("Face detector initialized")
 
+        # Warm up the shared detectors so the first request doesn't pay for model loading
+        from src.api.routes.analyze import get_heuristic_detector, get_torch_detector
+        get_heuristic_detector()
+        get_torch_detector()
+        logger.info("Detectors initialized")
+
         logger.info("Remorph API startup complete")
 
     except Exception as e:
@@ -43,6 +89,7 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("Shutting down Remorph API...")
+    flush_attribution_indexes()
 
 app = FastAPI(
     title="Remorph API",
@@ -51,7 +98,15 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Add middleware
+# Add middleware (the last added runs first; the size limit sits inside CORS so
+# browsers can read its 413)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={
+        "/analyze": max_request_bytes(),
+        "/analyze/batch": max_request_bytes(analyze.MAX_BATCH_FILES),
+    },
+)
 app.add_middleware(LoggingMiddleware)
 app.add_middleware(SecurityHeadersMiddleware)
 app.add_middleware(
@@ -1,18 +1,26 @@
+import threading
 import time
-from collections import defaultdict, deque
-from typing import Dict
+from collections import OrderedDict
+from typing import Tuple
 from fastapi import HTTPException, Request
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
 class RateLimiter:
-    """Simple in-memory rate limiter"""
+    """
+    Simple in-memory fixed-window rate limiter.
+    Keeps one (count, window_start) pair per client and evicts the least
+    recently seen clients beyond max_clients, so memory stays bounded.
+    Thread-safe: the dependency runs on the threadpool.
+    """
     
-    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
+    def __init__(self, max_requests: int = 10, window_seconds: int = 60, max_clients: int = 50000):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[str, deque] = defaultdict(deque)
+        self.max_clients = max_clients
+        self.clients: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
     
     def _get_client_id(self, request: Request) -> str:
         """Get client identifier from request"""
@@ -22,34 +30,37 @@ class RateLimiter:
             return forwarded.split(",")[0].strip()
         return request.client.host if request.client else "unknown"
     
-    def _cleanup_old_requests(self, client_id: str, current_time: float):
-        """Remove requests outside the time window"""
-        cutoff = current_time - self.window_seconds
-        while self.requests[client_id] and self.requests[client_id][0] < cutoff:
-            self.requests[client_id].popleft()
-    
     def check_rate_limit(self, request: Request) -> bool:
         """Check if request is within rate limits"""
         client_id = self._get_client_id(request)
-        current_time = time.time()
-        
-        # Clean up old requests
-        self._cleanup_old_requests(client_id, current_time)
+        current_time = time.monotonic()
         
-        # Check current request count
-        request_count = len(self.requests[client_id])
+        with self._lock:
+            # Start a new window if the previous one has expired
+            request_count, window_start = self.clients.get(client_id, (0, current_time))
+            if current_time - window_start >= self.window_seconds:
+                request_count, window_start = 0, current_time
+            
+            limited = request_count >= self.max_requests
+            if not limited:
+                # Record current request
+                request_count += 1
+                self.clients[client_id] = (request_count, window_start)
+            
+            # Mark client as most recently seen
+            if client_id in self.clients:
+                self.clients.move_to_end(client_id)
+            if len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
         
-        if request_count >= self.max_requests:
+        if limited:
             logger.warning(f"Rate limit exceeded for client {client_id}")
             raise HTTPException(
                 status_code=429,
                 detail=f"Rate limit exceeded. Max {self.max_requests} requests per {self.window_seconds} seconds."
             )
         
-        # Add current request
-        self.requests[client_id].append(current_time)
-        
-        logger.debug(f"Rate limit check passed for {client_id}: {request_count + 1}/{self.max_requests}")
+        logger.debug(f"Rate limit check passed for {client_id}: {request_count}/{self.max_requests}")
         return True
 
 # Global rate limiter instance
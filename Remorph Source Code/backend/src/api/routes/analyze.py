@@ -1,80 +1,328 @@
 import os
 import uuid
-from typing import Optional, List
+import asyncio
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, List, Tuple, TYPE_CHECKING
 from fastapi import APIRouter, UploadFile, File, HTTPException, Request, Depends
 from PIL import Image
 import numpy as np
 import cv2
 
-from src.config import OUTPUT_DIR, FINGERPRINTS_PATH, WEIGHTS_PATH
-from src.utils.img import load_image_from_bytes, ensure_min_size
+from src.config import (
+    OUTPUT_DIR, FINGERPRINTS_PATH, WEIGHTS_PATH, MAX_CONCURRENT_ANALYSES,
+    ENABLE_DEEP_GATE, DEEP_GATE_LOW, DEEP_GATE_HIGH
+)
+from src.utils.img import peek_image, decode_image, ensure_min_size, content_hash
 from src.utils.exif_utils import extract_exif_summary
-from src.utils.validation import validate_file_upload, validate_image_dimensions, sanitize_filename
+from src.utils.validation import (
+    validate_file_upload, validate_image_dimensions, sanitize_filename, read_upload_bounded
+)
 from src.utils.logging import setup_logger, log_analysis_request, log_analysis_result, log_error
 from src.ingest.filtering import accept_image
-from src.trace.attribution import AttributionIndex
-from src.models.detector import HeuristicDetector, TorchDetector
-from src.models.face_detector import face_detector
+from src.trace.attribution import get_attribution_index
 from src.api.rate_limiter import rate_limiter
 
+if TYPE_CHECKING:
+    from src.models.detector import HeuristicDetector, TorchDetector
+    from src.models.face_detector import FaceDetectorSingleton
+
 logger = setup_logger(__name__)
 router = APIRouter()
 
+DEFAULT_TARGET_LAYER = "layer4.1.conv2"
+MAX_BATCH_FILES = 5
+
+# Detectors are expensive to build (Torch weight load + graph setup), so they
+# are created once per process and shared across requests, like face_detector.
+# The Grad-CAM layer is chosen per call, so one Torch detector serves every layer.
+_heuristic_detector: Optional["HeuristicDetector"] = None
+_torch_detector: Optional["TorchDetector"] = None
+_detectors_lock = threading.Lock()
+
+# Per-thread scratch arrays for overlay rendering, reused across requests
+_scratch = threading.local()
+
+# Bounds how many CPU-heavy analyses run in worker threads at once
+analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+def _ensure_models():
+    """
+    Import the model modules on first use.
+    They pull in Torch and MTCNN, which processes that never analyze images shouldn't load.
+    Returns (detector_module, face_detector).
+    """
+    from src.models import detector
+    from src.models.face_detector import face_detector
+    return detector, face_detector
+
+def get_face_detector() -> "FaceDetectorSingleton":
+    """Return the shared face detector"""
+    return _ensure_models()[1]
+
+def get_heuristic_detector() -> "HeuristicDetector":
+    """Return the shared heuristic detector, creating it on first use"""
+    global _heuristic_detector
+    if _heuristic_detector is None:
+        detector_module, _ = _ensure_models()
+        with _detectors_lock:
+            if _heuristic_detector is None:
+                _heuristic_detector = detector_module.HeuristicDetector()
+    return _heuristic_detector
+
+def get_torch_detector() -> "TorchDetector":
+    """Return the shared Torch detector, loading the weights on first use"""
+    global _torch_detector
+    if _torch_detector is None:
+        detector_module, _ = _ensure_models()
+        with _detectors_lock:
+            if _torch_detector is None:
+                _torch_detector = detector_module.TorchDetector(
+                    WEIGHTS_PATH, device="cpu", target_layer=DEFAULT_TARGET_LAYER
+                )
+    return _torch_detector
+
 def check_rate_limit(request: Request):
     """Dependency for rate limiting"""
     return rate_limiter.check_rate_limit(request)
 
-def _create_fallback_heatmap(face_im: Image.Image) -> np.ndarray:
-    """Create forensic saliency map when Grad-CAM is not available"""
+def _create_fallback_heatmap(gray: np.ndarray, laplacian: np.ndarray) -> np.ndarray:
+    """
+    Create forensic saliency map when Grad-CAM is not available.
+    Takes the grayscale face and its int16 Laplacian from the heuristic pass.
+    """
     try:
-        arr = np.array(face_im.convert("L"))
-        
-        # Combine multiple forensic indicators
-        edges = cv2.Canny(arr, 80, 200).astype("float32")
-        
-        # Add Laplacian for texture analysis
-        laplacian = cv2.Laplacian(arr, cv2.CV_64F)
-        laplacian_norm = np.abs(laplacian).astype("float32")
-        laplacian_norm = (laplacian_norm / (laplacian_norm.max() + 1e-8)) * 255
-        
-        # Combine edge and texture information
-        combined = 0.7 * edges + 0.3 * laplacian_norm
-        combined = np.clip(combined, 0, 255)
-        
-        return combined / 255.0
+        # Combine edge and texture information in a single fused blend;
+        # saturating abs keeps the Laplacian in uint8 without float temporaries
+        edges = cv2.Canny(gray, 80, 200)
+        laplacian_abs = cv2.convertScaleAbs(laplacian)
+        return cv2.addWeighted(edges, 0.7 / 255.0, laplacian_abs, 0.3 / 255.0, 0.0, dtype=cv2.CV_32F)
         
     except Exception as e:
         logger.error(f"Fallback heatmap creation failed: {e}")
         # Return uniform heatmap as last resort
-        return np.ones((face_im.height, face_im.width), dtype=np.float32) * 0.5
+        return np.ones(gray.shape[:2], dtype=np.float32) * 0.5
+
+def _normalize_heatmap(heat: np.ndarray) -> np.ndarray:
+    """Min-max normalize a heatmap to a 2D uint8 array in one pass"""
+    if heat.ndim > 2:
+        heat = heat.squeeze()
+    return cv2.normalize(heat, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
-def _overlay_heatmap(base_rgb: np.ndarray, heat: np.ndarray, alpha: float = 0.45) -> np.ndarray:
-    """Create overlay of heatmap on original image"""
+def _scratch_buffer(name: str, shape: Tuple[int, ...]) -> np.ndarray:
+    """Return a per-thread uint8 scratch array, reused while the requested shape is unchanged"""
+    buf = getattr(_scratch, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_scratch, name, buf)
+    return buf
+
+def _overlay_same_size(base_rgb: np.ndarray, heat_uint8: np.ndarray, alpha: float = 0.45) -> np.ndarray:
+    """Overlay a normalized uint8 heatmap that already matches the base image size"""
     try:
-        # Normalize heatmap
-        heat_norm = (heat - heat.min()) / (heat.max() - heat.min() + 1e-8)
-        heat_uint8 = (255 * heat_norm).astype("uint8")
+        h, w = heat_uint8.shape[:2]
         
-        # Apply colormap
-        heat_color = cv2.applyColorMap(heat_uint8, cv2.COLORMAP_JET)
-        heat_color = cv2.cvtColor(heat_color, cv2.COLOR_BGR2RGB)
+        # Apply colormap (intermediates live in per-thread scratch buffers)
+        heat_bgr = cv2.applyColorMap(heat_uint8, cv2.COLORMAP_JET, dst=_scratch_buffer("heat_bgr", (h, w, 3)))
+        heat_color = cv2.cvtColor(heat_bgr, cv2.COLOR_BGR2RGB, dst=_scratch_buffer("heat_rgb", (h, w, 3)))
         
-        # Resize to match base image
-        if heat_color.shape[:2] != base_rgb.shape[:2]:
-            heat_color = cv2.resize(heat_color, (base_rgb.shape[1], base_rgb.shape[0]))
+        # Blend into a fresh array: it is saved after this thread may have moved on
+        return cv2.addWeighted(heat_color, alpha, base_rgb, 1 - alpha, 0)
         
-        # Blend
-        overlay = (alpha * heat_color + (1 - alpha) * base_rgb).astype("uint8")
-        return overlay
+    except Exception as e:
+        logger.error(f"Heatmap overlay creation failed: {e}")
+        return base_rgb  # Return original if overlay fails
+
+def _overlay_resize(base_rgb: np.ndarray, heat_uint8: np.ndarray, alpha: float = 0.45) -> np.ndarray:
+    """Overlay a low-resolution heatmap (e.g. Grad-CAM), upscaling it to the base image first"""
+    try:
+        h, w = base_rgb.shape[:2]
+        heat_resized = cv2.resize(heat_uint8, (w, h), dst=_scratch_buffer("heat_resized", (h, w)))
+        return _overlay_same_size(base_rgb, heat_resized, alpha)
         
     except Exception as e:
         logger.error(f"Heatmap overlay creation failed: {e}")
         return base_rgb  # Return original if overlay fails
 
+@dataclass
+class _Artifacts:
+    """Images produced by an analysis that still need to be written out"""
+    image: Image.Image
+    overlay: np.ndarray
+    heat_uint8: np.ndarray
+    heat_name: str
+    overlay_name: str
+
+def _output_names(uid: str) -> Tuple[str, str]:
+    """
+    Return (heatmap, overlay) paths relative to OUTPUT_DIR.
+    Outputs are grouped into per-day (UTC) directories so cleanup can drop whole days.
+    """
+    day = datetime.now(timezone.utc).strftime("%Y%m%d")
+    return f"{day}/heat_{uid}.png", f"{day}/overlay_{uid}.jpg"
+
+def _save_image(img: Image.Image, path: str, **params) -> None:
+    """Save an output image; create its directory and retry once if missing"""
+    try:
+        img.save(path, **params)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        img.save(path, **params)
+
+def _save_overlay(overlay: np.ndarray, path: str) -> None:
+    # Viewer artifacts, not archival data: favour fast encodes over size
+    _save_image(Image.fromarray(overlay), path, format="JPEG", quality=85, subsampling=2)
+
+def _save_heatmap(heat_uint8: np.ndarray, path: str) -> None:
+    _save_image(Image.fromarray(heat_uint8, mode='L'), path, format="PNG", compress_level=1)
+
+async def _write_outputs(artifacts: _Artifacts) -> Dict[str, Any]:
+    """
+    Save overlay and heatmap and extract EXIF concurrently on worker threads.
+    Returns the EXIF summary.
+    """
+    heat_path = os.path.join(OUTPUT_DIR, artifacts.heat_name)
+    overlay_path = os.path.join(OUTPUT_DIR, artifacts.overlay_name)
+    try:
+        _, _, exif = await asyncio.gather(
+            asyncio.to_thread(_save_overlay, artifacts.overlay, overlay_path),
+            asyncio.to_thread(_save_heatmap, artifacts.heat_uint8, heat_path),
+            asyncio.to_thread(extract_exif_summary, artifacts.image)
+        )
+    except Exception as e:
+        logger.error(f"Failed to save visualization files: {e}")
+        raise HTTPException(status_code=500, detail="Failed to generate visualizations")
+    return exif
+
+def _analyze_sync(
+    data: bytes, safe_filename: str, target_layer: Optional[str]
+) -> Tuple[Dict[str, Any], _Artifacts]:
+    """
+    Run the blocking analysis pipeline (decode, models) in a worker thread.
+    Returns (result, artifacts); files and EXIF are written by _write_outputs.
+    """
+    # Check dimensions from the header before decoding pixels
+    im = peek_image(data)
+    validate_image_dimensions(im)
+    im = ensure_min_size(decode_image(im, data), 256)
+    digest = content_hash(data)
+    
+    # Face detection
+    face_im, face_found, face_conf = get_face_detector().detect_largest_face(im)
+    
+    # Quality assessment
+    accept, qflags = accept_image(face_found, face_conf, face_im.width, face_im.height)
+    
+    # Heuristic analysis
+    heur_detector = get_heuristic_detector()
+    heur_score, heur_features, gray, laplacian = heur_detector.analyze_with_intermediates(face_im, content_hash=digest)
+    heur_result = {"score": heur_score, "features": heur_features}
+    
+    # Torch model analysis, skipped when the heuristic score is already decisive
+    deep_gated = ENABLE_DEEP_GATE and not (DEEP_GATE_LOW < heur_score < DEEP_GATE_HIGH)
+    torch_detector = get_torch_detector()
+    if deep_gated:
+        torch_pred = {"available": False}
+    else:
+        torch_pred = torch_detector.predict(face_im, content_hash=digest)
+    
+    # Calculate deep model score
+    deep_score = None
+    if torch_pred.get("available"):
+        probs = torch_pred["probs"]
+        if len(probs) == 1:
+            deep_score = float(probs[0])
+        elif len(probs) >= 2:
+            deep_score = float(1.0 - probs[1])  # Assuming [real, fake] order
+    
+    # Generate heatmap
+    heat = None
+    if torch_pred.get("available"):
+        heat = torch_detector.gradcam(face_im, class_idx=None, target_layer=target_layer)
+    used_gradcam = heat is not None
+    
+    if heat is None:
+        heat = _create_fallback_heatmap(gray, laplacian)
+    
+    # Attribution analysis
+    try:
+        attribution_idx = get_attribution_index(FINGERPRINTS_PATH)
+        topk_matches = attribution_idx.match(heur_result["features"], topk=3)
+    except Exception as e:
+        logger.error(f"Attribution analysis failed: {e}")
+        topk_matches = []
+    
+    # Prepare visualizations (OUTPUT_DIR is created at startup)
+    uid = uuid.uuid4().hex[:12]
+    
+    base_rgb = np.asarray(face_im)
+    
+    # Normalize once; shared by the overlay and the saved grayscale heatmap
+    heat_uint8 = _normalize_heatmap(heat)
+    if heat_uint8.shape[:2] == (face_im.height, face_im.width):
+        overlay = _overlay_same_size(base_rgb, heat_uint8)
+    else:
+        overlay = _overlay_resize(base_rgb, heat_uint8)
+    
+    heat_name, overlay_name = _output_names(uid)
+    
+    # Frequency metadata
+    try:
+        freq_meta = {
+            "fft_high_ratio": heur_result["features"]["fft_high_ratio"],
+            "lap_var": heur_result["features"]["lap_var"],
+            "jpeg_score": heur_result["features"]["jpeg_score"]
+        }
+    except Exception as e:
+        logger.error(f"Metadata extraction failed: {e}")
+        freq_meta = {}
+    
+    # Build response
+    result = {
+        "id": uid,
+        "received_filename": safe_filename,
+        "face": {
+            "found": face_found,
+            "confidence": face_conf,
+            "used_region": [face_im.width, face_im.height]
+        },
+        "quality": {
+            "accepted_for_learning": accept,
+            "flags": qflags.__dict__
+        },
+        "scores": {
+            "heuristic_deepfake_score": heur_result["score"],
+            "deep_model_score": deep_score
+        },
+        "features": heur_result["features"],
+        "attribution_topk": [
+            {"family": name, "similarity": float(sim)} 
+            for name, sim in topk_matches
+        ],
+        "exif": {},
+        "frequency_meta": freq_meta,
+        "files": {
+            "heatmap_url": f"/files/{heat_name}",
+            "overlay_url": f"/files/{overlay_name}"
+        },
+        "notes": [
+            "Deep model skipped (decisive heuristic score)" if deep_gated
+            else "Deep model unavailable" if not torch_pred.get("available") else "Deep model used",
+            f"Grad-CAM layer={target_layer}" if used_gradcam else "Forensic fallback heatmap"
+        ]
+    }
+    
+    return result, _Artifacts(im, overlay, heat_uint8, heat_name, overlay_name)
+
+def _decode_uploads(uploads: List[Tuple[Image.Image, bytes]]) -> List[Image.Image]:
+    """Decode peeked uploads and upscale them to the minimum analysis size"""
+    return [ensure_min_size(decode_image(im, data), 256) for im, data in uploads]
+
 @router.post("/analyze")
 async def analyze(
     file: UploadFile = File(...),
-    target_layer: Optional[str] = "layer4.1.conv2",
+    target_layer: Optional[str] = DEFAULT_TARGET_LAYER,
     _: bool = Depends(check_rate_limit)
 ):
     """
@@ -82,9 +330,8 @@ async def analyze(
     Returns JSON with scores, features, and URLs to generated visualizations.
     """
     
-    # Validate file upload
-    file_size = 0
-    data = await file.read()
+    # Validate file upload (oversized Content-Length is rejected by UploadSizeLimitMiddleware)
+    data = await read_upload_bounded(file)
     file_size = len(data)
     
     safe_filename = sanitize_filename(file.filename or "unknown.jpg")
@@ -93,133 +340,19 @@ async def analyze(
         validate_file_upload(safe_filename, file_size)
         log_analysis_request(logger, safe_filename, file_size)
         
-        # Load and validate image
-        im = load_image_from_bytes(data)
-        validate_image_dimensions(im)
-        im = ensure_min_size(im, 256)
-        
-        # Face detection
-        face_im, face_found, face_conf = face_detector.detect_largest_face(im)
-        
-        # Quality assessment
-        accept, qflags = accept_image(face_found, face_conf, face_im.width, face_im.height)
-        
-        # Heuristic analysis
-        heur_detector = HeuristicDetector()
-        heur_result = heur_detector.analyze(face_im)
-        
-        # Torch model analysis
-        torch_detector = TorchDetector(WEIGHTS_PATH, device="cpu", target_layer=target_layer)
-        torch_pred = torch_detector.predict(face_im)
-        
-        # Calculate deep model score
-        deep_score = None
-        if torch_pred.get("available"):
-            probs = torch_pred["probs"]
-            if len(probs) == 1:
-                deep_score = float(probs[0])
-            elif len(probs) >= 2:
-                deep_score = float(1.0 - probs[1])  # Assuming [real, fake] order
-        
-        # Generate heatmap
-        heat = None
-        if torch_pred.get("available"):
-            heat = torch_detector.gradcam(face_im, class_idx=None)
-        
-        if heat is None:
-            heat = _create_fallback_heatmap(face_im)
-        
-        # Attribution analysis
-        try:
-            attribution_idx = AttributionIndex(FINGERPRINTS_PATH)
-            topk_matches = attribution_idx.match(heur_result["features"], topk=3)
-        except Exception as e:
-            logger.error(f"Attribution analysis failed: {e}")
-            topk_matches = []
-        
-        # Save visualizations
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        uid = uuid.uuid4().hex[:12]
-        
-        base_rgb = np.array(face_im)
-        
-        # Handle different heatmap dimensions
-        if heat.ndim == 2:
-            overlay = _overlay_heatmap(base_rgb, heat)
-        else:
-            heat_2d = heat.squeeze() if heat.ndim > 2 else heat
-            overlay = _overlay_heatmap(base_rgb, heat_2d)
-        
-        # Save files
-        heat_path = os.path.join(OUTPUT_DIR, f"heat_{uid}.png")
-        overlay_path = os.path.join(OUTPUT_DIR, f"overlay_{uid}.png")
-        
-        try:
-            Image.fromarray(overlay).save(overlay_path)
-            
-            # Save heatmap as grayscale
-            heat_norm = (heat - np.min(heat)) / (np.max(heat) - np.min(heat) + 1e-8)
-            heat_uint8 = (255 * heat_norm).astype("uint8")
-            if heat_uint8.ndim > 2:
-                heat_uint8 = heat_uint8.squeeze()
-            Image.fromarray(heat_uint8, mode='L').save(heat_path)
-            
-        except Exception as e:
-            logger.error(f"Failed to save visualization files: {e}")
-            raise HTTPException(status_code=500, detail="Failed to generate visualizations")
-        
-        # Extract metadata
-        try:
-            exif = extract_exif_summary(im)
-            freq_meta = {
-                "fft_high_ratio": heur_result["features"]["fft_high_ratio"],
-                "lap_var": heur_result["features"]["lap_var"],
-                "jpeg_score": heur_result["features"]["jpeg_score"]
-            }
-        except Exception as e:
-            logger.error(f"Metadata extraction failed: {e}")
-            exif = {}
-            freq_meta = {}
-        
-        # Build response
-        result = {
-            "id": uid,
-            "received_filename": safe_filename,
-            "face": {
-                "found": face_found,
-                "confidence": face_conf,
-                "used_region": [face_im.width, face_im.height]
-            },
-            "quality": {
-                "accepted_for_learning": accept,
-                "flags": qflags.__dict__
-            },
-            "scores": {
-                "heuristic_deepfake_score": heur_result["score"],
-                "deep_model_score": deep_score
-            },
-            "features": heur_result["features"],
-            "attribution_topk": [
-                {"family": name, "similarity": float(sim)} 
-                for name, sim in topk_matches
-            ],
-            "exif": exif,
-            "frequency_meta": freq_meta,
-            "files": {
-                "heatmap_url": f"/files/{os.path.basename(heat_path)}",
-                "overlay_url": f"/files/{os.path.basename(overlay_path)}"
-            },
-            "notes": [
-                "Deep model unavailable" if not torch_pred.get("available") else "Deep model used",
-                "Forensic fallback heatmap" if not torch_pred.get("available") else f"Grad-CAM layer={target_layer}"
-            ]
-        }
+        async with analysis_semaphore:
+            result, artifacts = await asyncio.to_thread(
+                _analyze_sync, data, safe_filename, target_layer
+            )
+            result["exif"] = await _write_outputs(artifacts)
         
         log_analysis_result(logger, result)
         return result
         
     except HTTPException:
         raise
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=400, detail="Image exceeds the maximum pixel count")
     except Exception as e:
         log_error(logger, e, "image analysis")
         raise HTTPException(status_code=500, detail="Internal analysis error")
@@ -230,23 +363,26 @@ async def analyze_batch(files: List[UploadFile] = File(...)):
     Analyze multiple images in batch.
     Limited to 5 images per request to prevent resource exhaustion.
     """
-    if len(files) > 5:
+    if len(files) > MAX_BATCH_FILES:
         raise HTTPException(
             status_code=400,
-            detail="Maximum 5 images per batch request"
+            detail=f"Maximum {MAX_BATCH_FILES} images per batch request"
         )
     
     logger.info(f"Batch analysis request: {len(files)} files")
     
     try:
-        # Load all images first
-        images = []
+        # Validate every upload from its header, then decode them all on a worker thread
+        uploads = []
         for file in files:
-            data = await file.read()
+            data = await read_upload_bounded(file)
             validate_file_upload(sanitize_filename(file.filename or ""), len(data))
-            im = load_image_from_bytes(data)
+            im = peek_image(data)
             validate_image_dimensions(im)
-            images.append(ensure_min_size(im, 256))
+            uploads.append((im, data))
+        
+        async with analysis_semaphore:
+            images = await asyncio.to_thread(_decode_uploads, uploads)
         
         # Process batch
         from src.api.batch_processor import batch_processor
@@ -260,6 +396,8 @@ async def analyze_batch(files: List[UploadFile] = File(...)):
         
     except HTTPException:
         raise
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=400, detail="Image exceeds the maximum pixel count")
     except Exception as e:
         log_error(logger, e, "batch analysis")
         raise HTTPException(status_code=500, detail="Batch analysis failed")
\ No newline at end of file
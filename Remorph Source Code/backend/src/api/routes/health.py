@@ -1,7 +1,6 @@
 import os
 import psutil
 from datetime import datetime
-import psutil
 from fastapi import APIRouter
 from src.config import OUTPUT_DIR, FINGERPRINTS_PATH, WEIGHTS_PATH
 from src.utils.logging import setup_logger
@@ -73,26 +72,26 @@ def detailed_health():
             "components": {}
         }
         
-        # Test heuristic detector
+        # Test heuristic detector (shared instance, created once per process)
         try:
-            from src.models.detector import HeuristicDetector
-            detector = HeuristicDetector()
+            from src.api.routes.analyze import get_heuristic_detector
+            get_heuristic_detector()
             results["components"]["heuristic_detector"] = "available"
         except Exception as e:
             results["components"]["heuristic_detector"] = f"error: {str(e)}"
         
         # Test torch detector
         try:
-            from src.models.detector import TorchDetector
-            torch_det = TorchDetector(WEIGHTS_PATH)
+            from src.api.routes.analyze import get_torch_detector
+            torch_det = get_torch_detector()
             results["components"]["torch_detector"] = "available" if torch_det.available else "weights_not_found"
         except Exception as e:
             results["components"]["torch_detector"] = f"error: {str(e)}"
         
         # Test attribution index
         try:
-            from src.trace.attribution import AttributionIndex
-            idx = AttributionIndex(FINGERPRINTS_PATH)
+            from src.trace.attribution import get_attribution_index
+            idx = get_attribution_index(FINGERPRINTS_PATH)
             families = idx.all_families()
             results["components"]["attribution_index"] = f"available ({len(families)} families)"
         except Exception as e:
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from src.config import FINGERPRINTS_PATH
-from src.trace.attribution import AttributionIndex
+from src.trace.attribution import get_attribution_index
 from src.utils.logging import setup_logger, log_error
 
 logger = setup_logger(__name__)
@@ -10,7 +10,7 @@ router = APIRouter()
 def get_stats():
     """Get system and attribution statistics"""
     try:
-        attribution_idx = AttributionIndex(FINGERPRINTS_PATH)
+        attribution_idx = get_attribution_index(FINGERPRINTS_PATH)
         stats = attribution_idx.get_family_stats()
         
         return {
@@ -29,7 +29,7 @@ def get_stats():
 def get_families():
     """Get all attribution families"""
     try:
-        attribution_idx = AttributionIndex(FINGERPRINTS_PATH)
+        attribution_idx = get_attribution_index(FINGERPRINTS_PATH)
         families = attribution_idx.all_families()
         
         return {
@@ -5,15 +5,26 @@ from typing import Dict, Any
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "outputs")
 FINGERPRINTS_PATH = os.getenv("FINGERPRINTS_PATH", "data/fingerprints.json")
 WEIGHTS_PATH = os.getenv("WEIGHTS_PATH", "weights/detector.pt")
+# Seconds to batch fingerprint updates before writing them (0 = write on every update).
+# Assumes a single writer process for FINGERPRINTS_PATH.
+FINGERPRINTS_FLUSH_INTERVAL = float(os.getenv("FINGERPRINTS_FLUSH_INTERVAL", "5.0"))
 
 # API Configuration
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "10"))
 MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "4096"))
 MIN_IMAGE_DIMENSION = int(os.getenv("MIN_IMAGE_DIMENSION", "224"))
+MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", str(os.cpu_count() or 1)))
 
 # Detection thresholds
 FACE_CONFIDENCE_THRESHOLD = float(os.getenv("FACE_CONFIDENCE_THRESHOLD", "0.90"))
 QUALITY_MIN_SIDE = int(os.getenv("QUALITY_MIN_SIDE", "224"))
+# Optional cap on the longest side of the copy MTCNN searches (0 = full size, the
+# default); boxes are mapped back to the full-resolution image for cropping. Capping
+# trades recall for speed: MTCNN misses faces under ~20px at the capped size
+FACE_DETECT_MAX_SIDE = int(os.getenv("FACE_DETECT_MAX_SIDE", "0"))
+
+# Dynamically quantize eager Torch models to int8 for CPU inference (0 keeps fp32 weights)
+TORCH_QUANTIZE = os.getenv("TORCH_QUANTIZE", "1").lower() in ("1", "true", "yes")
 
 # Heuristic weights
 HEURISTIC_WEIGHTS = {
@@ -25,6 +36,17 @@ HEURISTIC_WEIGHTS = {
     "steepness": float(os.getenv("HEURISTIC_STEEPNESS", "4.0"))
 }
 
+# Longest side used for JPEG re-encoding features (ELA, quantization score); 0 = full size
+HEURISTIC_ENCODE_MAX_SIDE = int(os.getenv("HEURISTIC_ENCODE_MAX_SIDE", "512"))
+
+# Per-detector LRU cache of results keyed by upload content hash (0 disables)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+
+# Skip the deep model / Grad-CAM when the heuristic score is outside (low, high)
+ENABLE_DEEP_GATE = os.getenv("ENABLE_DEEP_GATE", "false").lower() in ("1", "true", "yes")
+DEEP_GATE_LOW = float(os.getenv("DEEP_GATE_LOW", "0.05"))
+DEEP_GATE_HIGH = float(os.getenv("DEEP_GATE_HIGH", "0.95"))
+
 # Supported image formats
 SUPPORTED_FORMATS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
 
@@ -35,12 +57,27 @@ def validate_config():
     if MAX_FILE_SIZE_MB <= 0:
         errors.append("MAX_FILE_SIZE_MB must be positive")
     
+    if MAX_CONCURRENT_ANALYSES <= 0:
+        errors.append("MAX_CONCURRENT_ANALYSES must be positive")
+    
+    if FINGERPRINTS_FLUSH_INTERVAL < 0:
+        errors.append("FINGERPRINTS_FLUSH_INTERVAL must be non-negative")
+    
     if MAX_IMAGE_DIMENSION <= MIN_IMAGE_DIMENSION:
         errors.append("MAX_IMAGE_DIMENSION must be greater than MIN_IMAGE_DIMENSION")
     
     if not (0.0 <= FACE_CONFIDENCE_THRESHOLD <= 1.0):
         errors.append("FACE_CONFIDENCE_THRESHOLD must be between 0.0 and 1.0")
     
+    if FACE_DETECT_MAX_SIDE < 0:
+        errors.append("FACE_DETECT_MAX_SIDE must be non-negative")
+    
+    if HEURISTIC_ENCODE_MAX_SIDE < 0:
+        errors.append("HEURISTIC_ENCODE_MAX_SIDE must be non-negative")
+    
+    if not (0.0 <= DEEP_GATE_LOW < DEEP_GATE_HIGH <= 1.0):
+        errors.append("DEEP_GATE_LOW and DEEP_GATE_HIGH must satisfy 0.0 <= low < high <= 1.0")
+    
     if errors:
         raise ValueError(f"Configuration errors: {'; '.join(errors)}")
     
@@ -1,10 +1,16 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Tuple
+import numpy as np
 from src.config import FACE_CONFIDENCE_THRESHOLD, QUALITY_MIN_SIDE
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
+# Bit flags returned by accept_image_batch (one per rejection reason)
+FLAG_LOW_FACE_CONF = 1
+FLAG_NO_FACE = 2
+FLAG_MIN_SIDE = 4
+
 @dataclass
 class QualityFlags:
     face_found: bool
@@ -47,4 +53,30 @@ def accept_image(
     
     logger.debug(f"Quality assessment: accept={accept}, flags={flags}")
     
-    return accept, flags
\ No newline at end of file
+    return accept, flags
+
+def accept_image_batch(
+    face_found: np.ndarray,
+    face_conf: np.ndarray,
+    width: np.ndarray,
+    height: np.ndarray,
+    min_side: int = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized accept_image for gallery filtering.
+    Returns (accept bool array, uint8 array of FLAG_* bits per image).
+    """
+    if min_side is None:
+        min_side = QUALITY_MIN_SIDE
+    
+    found = np.asarray(face_found, dtype=bool)
+    conf = np.asarray(face_conf, dtype=np.float64)
+    min_side_ok = np.minimum(width, height) >= min_side
+    conf_ok = conf >= FACE_CONFIDENCE_THRESHOLD
+    
+    flags = np.zeros(found.shape, dtype=np.uint8)
+    flags[~min_side_ok] |= FLAG_MIN_SIDE
+    flags[~found] |= FLAG_NO_FACE
+    flags[found & ~conf_ok] |= FLAG_LOW_FACE_CONF
+    
+    return found & conf_ok & min_side_ok, flags
\ No newline at end of file
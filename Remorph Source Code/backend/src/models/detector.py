@@ -1,32 +1,76 @@
+import math
 import os
-from typing import Dict, Any, Optional
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 import numpy as np
 from PIL import Image
-import torch
-import torchvision.transforms as T
 
 from src.utils.ela import error_level_analysis
-from src.utils.frequency import fft_highfreq_ratio, laplacian_variance, jpeg_quant_score
-from src.config import HEURISTIC_WEIGHTS
+from src.utils.frequency import fft_highfreq_ratio, grayscale_laplacian, jpeg_quant_score, variance
+from src.utils.cache import LRUCache
+from src.utils.img import prep_for_encode
+from src.config import HEURISTIC_WEIGHTS, HEURISTIC_ENCODE_MAX_SIDE, RESULT_CACHE_SIZE, TORCH_QUANTIZE
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
+# Column order of feature matrices passed to HeuristicDetector.score_batch
+FEATURE_KEYS = ("ela_mean", "fft_high_ratio", "lap_var", "jpeg_score")
+
+def _map_threaded(fn, items: List[Any], max_workers: Optional[int] = None) -> List[Any]:
+    """map() over a thread pool sized to the CPUs (and the number of items)"""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    
+    workers = min(len(items), max_workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(fn, items))
+
 class HeuristicDetector:
     """
     Lightweight, CPU-first heuristics. Returns a score in [0,1].
     """
     def __init__(self, weights: Optional[Dict[str, float]] = None):
         self.weights = weights or HEURISTIC_WEIGHTS
+        self._features_cache = LRUCache(RESULT_CACHE_SIZE)
+        # score()'s linear combination as a weight vector over FEATURE_KEYS,
+        # with the per-feature normalisation folded in
+        self._w = np.array([
+            self.weights["ela_weight"] / 50.0,
+            self.weights["fft_weight"],
+            self.weights["lap_weight"] / 200.0,
+            -self.weights["jpeg_weight"]
+        ], dtype=np.float64)
         logger.info("Heuristic detector initialized with configurable weights")
 
-    def features(self, im: Image.Image) -> Dict[str, float]:
-        """Extract forensic features from image"""
+    def features(
+        self,
+        im: Image.Image,
+        gray: Optional[np.ndarray] = None,
+        laplacian: Optional[np.ndarray] = None,
+        content_hash: Optional[str] = None
+    ) -> Dict[str, float]:
+        """
+        Extract forensic features from image, reusing gray/laplacian if already computed.
+        With content_hash (see src.utils.img.content_hash) results are memoized per upload.
+        """
+        if content_hash is not None:
+            cached = self._features_cache.get(content_hash)
+            if cached is not None:
+                return dict(cached)
+        
         try:
-            ela_img, ela_mean = error_level_analysis(im, quality=90)
-            fft_ratio = fft_highfreq_ratio(im)
-            lap_var = laplacian_variance(im)
-            jq = jpeg_quant_score(im)
+            if gray is None or laplacian is None:
+                gray, laplacian = grayscale_laplacian(im)
+            
+            # The JPEG re-encoding features run on one shared downscaled copy
+            enc_im = prep_for_encode(im, HEURISTIC_ENCODE_MAX_SIDE)
+            _, ela_mean = error_level_analysis(enc_im, quality=90, visualize=False)
+            fft_ratio = fft_highfreq_ratio(gray)
+            lap_var = variance(laplacian)
+            jq = jpeg_quant_score(enc_im)
             
             features = {
                 "ela_mean": ela_mean,
@@ -36,6 +80,8 @@ class HeuristicDetector:
             }
             
             logger.debug(f"Extracted features: {features}")
+            if content_hash is not None:
+                self._features_cache.put(content_hash, dict(features))
             return features
             
         except Exception as e:
@@ -58,9 +104,15 @@ class HeuristicDetector:
                 self.weights["jpeg_weight"] * feats["jpeg_score"]
             )
             
-            # Sigmoid activation
-            s = 1.0 / (1.0 + np.exp(-self.weights["steepness"] * (x - self.weights["threshold"])))
-            score = float(np.clip(s, 0.0, 1.0))
+            # Sigmoid activation on plain floats (math.exp avoids ufunc dispatch);
+            # written in the overflow-safe form for either sign of z
+            z = self.weights["steepness"] * (x - self.weights["threshold"])
+            if z >= 0:
+                s = 1.0 / (1.0 + math.exp(-z))
+            else:
+                e = math.exp(z)
+                s = e / (1.0 + e)
+            score = max(0.0, min(1.0, float(s)))
             
             logger.debug(f"Calculated heuristic score: {score:.3f}")
             return score
@@ -69,29 +121,82 @@ class HeuristicDetector:
             logger.error(f"Score calculation failed: {e}")
             return 0.5  # Default neutral score
 
-    def analyze(self, im: Image.Image) -> Dict[str, Any]:
+    def clear_features_cache(self):
+        """Drop memoized features (e.g. between tests or after changing settings)"""
+        self._features_cache.clear()
+
+    @staticmethod
+    def feature_matrix(feats_list: List[Dict[str, float]]) -> np.ndarray:
+        """Stack feature dicts into an (N, 4) array in FEATURE_KEYS order"""
+        matrix = np.array([[f[k] for k in FEATURE_KEYS] for f in feats_list], dtype=np.float64)
+        return matrix.reshape(-1, len(FEATURE_KEYS))
+
+    def score_batch(self, feat_matrix: np.ndarray) -> np.ndarray:
+        """
+        Vectorized score() for an (N, 4) feature matrix (see feature_matrix),
+        returning (N,) scores from one matrix-vector product.
+        """
+        x = np.asarray(feat_matrix, dtype=np.float64) @ self._w
+        z = self.weights["steepness"] * (x - self.weights["threshold"])
+        # tanh form of the sigmoid does not overflow for large |z|
+        return np.clip(0.5 * (1.0 + np.tanh(0.5 * z)), 0.0, 1.0)
+
+    def analyze(self, im: Image.Image, content_hash: Optional[str] = None) -> Dict[str, Any]:
         """Full heuristic analysis"""
-        feats = self.features(im)
+        feats = self.features(im, content_hash=content_hash)
         s = self.score(feats)
         return {"score": s, "features": feats}
 
+    def analyze_batch(self, ims: List[Image.Image], max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Heuristic analysis of several images in parallel threads.
+        The heavy kernels (FFT, Laplacian, JPEG encode) release the GIL.
+        """
+        return _map_threaded(self.analyze, ims, max_workers)
+
+    def features_batch(
+        self, ims: List[Image.Image], max_workers: Optional[int] = None
+    ) -> Dict[str, np.ndarray]:
+        """
+        Features of several images, extracted in parallel threads, as a dict of
+        (N,) arrays keyed by FEATURE_KEYS. np.column_stack of those arrays in
+        FEATURE_KEYS order is the input score_batch expects.
+        """
+        feats_list = _map_threaded(self.features, ims, max_workers)
+        matrix = self.feature_matrix(feats_list)
+        return {k: matrix[:, i].copy() for i, k in enumerate(FEATURE_KEYS)}
+
+    def analyze_with_intermediates(
+        self, im: Image.Image, content_hash: Optional[str] = None
+    ) -> Tuple[float, Dict[str, float], np.ndarray, np.ndarray]:
+        """
+        Full heuristic analysis that also returns the grayscale image and its
+        int16 Laplacian, so callers (e.g. the fallback heatmap) need not recompute them.
+        Returns (score, features, gray, laplacian).
+        """
+        gray, laplacian = grayscale_laplacian(im)
+        feats = self.features(im, gray, laplacian, content_hash=content_hash)
+        return self.score(feats), feats, gray, laplacian
+
 
 class TorchDetector:
     """
     Optional Torch model with improved error handling and caching.
+    torch/torchvision are only imported once weights are found, so processes
+    without a model don't pay for importing them.
     """
     def __init__(self, weights_path: str, device: Optional[str] = None, target_layer: Optional[str] = None):
         self.weights_path = weights_path
         self.available = os.path.exists(weights_path)
         self.model = None
-        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.infer_model = None
+        self.transform = None
+        self.device = device
         self.target_layer = target_layer
-        
-        self.transform = T.Compose([
-            T.Resize((224, 224)),
-            T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        self._layer_names: frozenset = frozenset()
+        # Grad-CAM hooks live on self.model, which is shared by every analysis thread
+        self._hook_lock = threading.Lock()
+        self._predict_cache = LRUCache(RESULT_CACHE_SIZE)
         
         if self.available:
             self._load_model()
@@ -99,29 +204,87 @@ class TorchDetector:
     def _load_model(self):
         """Load the torch model with proper error handling"""
         try:
+            import torch
+            import torchvision.transforms as T
+            
+            if self.device is None:
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            
+            # Convert to a uint8 tensor first so resize/normalize run as tensor ops
+            self.transform = T.Compose([
+                T.PILToTensor(),
+                T.Resize((224, 224), antialias=True),
+                T.ConvertImageDtype(torch.float32),
+                T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            ])
+            
             if self.weights_path.endswith(".pt"):
                 self.model = torch.jit.load(self.weights_path, map_location=self.device)
             else:
                 self.model = torch.load(self.weights_path, map_location=self.device)
             
             self.model.eval()
+            self._layer_names = frozenset(name for name, _ in self.model.named_modules())
+            self.infer_model = self._build_inference_model(self.model)
             logger.info(f"Torch model loaded successfully from {self.weights_path}")
             
         except Exception as e:
             logger.error(f"Failed to load torch model: {e}")
             self.available = False
             self.model = None
+            self.infer_model = None
 
-    def predict(self, im: Image.Image) -> Dict[str, Any]:
-        """Predict with the torch model"""
-        if not self.available or self.model is None:
+    def _build_inference_model(self, model):
+        """
+        Build the module used by predict(). Weights are moved to channels-last layout;
+        TorchScript models are frozen and optimized for inference, and on CPU Linear
+        layers of eager models are dynamically quantized to int8 (TORCH_QUANTIZE).
+        Grad-CAM keeps the unfrozen fp32 model since it needs gradients and layer hooks.
+        """
+        import torch
+        
+        model = model.to(memory_format=torch.channels_last)
+        
+        if isinstance(model, torch.jit.ScriptModule):
+            try:
+                frozen = torch.jit.optimize_for_inference(torch.jit.freeze(model))
+                logger.info("Using frozen TorchScript model for inference")
+                return frozen
+            except Exception as e:
+                logger.warning(f"TorchScript freeze unavailable, using loaded model: {e}")
+                return model
+        
+        if self.device != "cpu" or not TORCH_QUANTIZE:
+            return model
+        
+        try:
+            quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            logger.info("Using dynamically quantized (int8) model for inference")
+            return quantized
+        except Exception as e:
+            logger.warning(f"Dynamic quantization unavailable, using fp32 model: {e}")
+            return model
+
+    def predict(self, im: Image.Image, content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """Predict with the torch model; successful results are memoized by content_hash"""
+        if not self.available or self.infer_model is None:
             return {"available": False, "error": "Model not available"}
         
+        if content_hash is not None:
+            cached = self._predict_cache.get(content_hash)
+            if cached is not None:
+                return {"available": True, "probs": list(cached)}
+        
         try:
-            x = self.transform(im).unsqueeze(0).to(self.device)
+            import torch
+            x = self.transform(im).unsqueeze(0).to(
+                self.device, memory_format=torch.channels_last, non_blocking=True
+            )
             
-            with torch.no_grad():
-                logits = self.model(x)
+            # When predict() runs on self.model itself, Grad-CAM hooks would see it
+            hooks_shared = self.infer_model is self.model
+            with self._hook_lock if hooks_shared else nullcontext(), torch.inference_mode():
+                logits = self.infer_model(x)
             
             if logits.ndim == 1:
                 logits = logits.unsqueeze(0)
@@ -129,21 +292,36 @@ class TorchDetector:
             probs = torch.softmax(logits, dim=1).detach().cpu().numpy()[0].tolist()
             
             logger.debug(f"Torch model prediction: {probs}")
+            if content_hash is not None:
+                self._predict_cache.put(content_hash, tuple(probs))
             return {"available": True, "probs": probs}
             
         except Exception as e:
             logger.error(f"Torch model prediction failed: {e}")
             return {"available": False, "error": str(e)}
 
-    def gradcam(self, im: Image.Image, class_idx: Optional[int] = None) -> Optional[np.ndarray]:
-        """Generate Grad-CAM heatmap"""
-        if not self.available or self.model is None or self.target_layer is None:
+    def gradcam(
+        self, im: Image.Image, class_idx: Optional[int] = None, target_layer: Optional[str] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Generate Grad-CAM heatmap at target_layer (default: the detector's layer).
+        Returns None for layers the model doesn't have. Calls are serialized, since
+        the hooks are attached to the shared model.
+        """
+        layer = target_layer or self.target_layer
+        if not self.available or self.model is None or layer is None:
+            return None
+        
+        if layer not in self._layer_names:
+            logger.warning(f"Unknown Grad-CAM layer: {layer[:100]}")
             return None
         
         try:
             from src.models.gradcam import GradCAM
             x = self.transform(im).unsqueeze(0).to(self.device).requires_grad_(True)
-            cam = GradCAM(self.model, self.target_layer).generate(x, class_idx=class_idx)
+            # Hook registration, forward and backward must not interleave across threads
+            with self._hook_lock:
+                cam = GradCAM(self.model, layer).generate(x, class_idx=class_idx)
             return cam.numpy()
             
         except Exception as e:
@@ -1,6 +1,9 @@
+import threading
 import numpy as np
 from PIL import Image
-from typing import Tuple, Optional
+from typing import Dict, List, Tuple, Optional
+from src.config import FACE_DETECT_MAX_SIDE
+from src.utils.img import limit_max_side
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
@@ -8,22 +11,31 @@ logger = setup_logger(__name__)
 class FaceDetectorSingleton:
     """Singleton MTCNN face detector to avoid recreating on each request"""
     _instance = None
+    _lock = threading.Lock()
     _mtcnn = None
     _available = False
+    device = "cpu"
     
     def __new__(cls):
+        # Double-checked so concurrent first calls build MTCNN exactly once, and
+        # the instance is only published after it is fully initialized
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialize()
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._initialize()
+                    cls._instance = instance
         return cls._instance
     
     def _initialize(self):
         """Initialize MTCNN detector once"""
         try:
+            import torch
             from facenet_pytorch import MTCNN
-            self._mtcnn = MTCNN(keep_all=True, device="cpu")
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self._mtcnn = MTCNN(keep_all=True, device=self.device)
             self._available = True
-            logger.info("MTCNN face detector initialized successfully")
+            logger.info(f"MTCNN face detector initialized successfully on {self.device}")
         except Exception as e:
             logger.warning(f"MTCNN not available: {e}")
             self._available = False
@@ -38,36 +50,83 @@ class FaceDetectorSingleton:
             return pil_im, False, 0.0
         
         try:
-            boxes, probs = self._mtcnn.detect(pil_im)
-            
-            if boxes is None or len(boxes) == 0:
-                logger.debug("No faces detected in image")
-                return pil_im, False, 0.0
-            
-            # Find the face with highest confidence
-            best_i = int(np.argmax(probs))
-            x1, y1, x2, y2 = [int(v) for v in boxes[best_i]]
-            conf = float(probs[best_i])
-            
-            # Ensure coordinates are within image bounds
-            x1 = max(0, x1)
-            y1 = max(0, y1)
-            x2 = min(pil_im.width, x2)
-            y2 = min(pil_im.height, y2)
-            
-            # Validate face region
-            if x2 <= x1 or y2 <= y1:
-                logger.warning("Invalid face coordinates detected")
-                return pil_im, False, 0.0
-            
-            face = pil_im.crop((x1, y1, x2, y2))
-            logger.debug(f"Face detected: confidence={conf:.3f}, size={face.size}")
-            
-            return face, True, conf
+            det_im = limit_max_side(pil_im, FACE_DETECT_MAX_SIDE)
+            boxes, probs = self._mtcnn.detect(det_im)
+            return self._crop_best(pil_im, boxes, probs, det_im.size)
             
         except Exception as e:
             logger.error(f"Face detection failed: {e}")
             return pil_im, False, 0.0
+    
+    def detect_largest_faces(self, pil_ims: List[Image.Image]) -> List[Tuple[Image.Image, bool, float]]:
+        """
+        Batched detect_largest_face. MTCNN only batches equal-sized images, so images
+        are grouped by size and each group runs as one forward pass (worthwhile on GPU).
+        """
+        if not self._available or self._mtcnn is None:
+            return [self.detect_largest_face(im) for im in pil_ims]
+        
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, im in enumerate(pil_ims):
+            groups.setdefault(im.size, []).append(i)
+        
+        results: List[Optional[Tuple[Image.Image, bool, float]]] = [None] * len(pil_ims)
+        for indices in groups.values():
+            if len(indices) == 1:
+                results[indices[0]] = self.detect_largest_face(pil_ims[indices[0]])
+                continue
+            
+            try:
+                det_ims = [limit_max_side(pil_ims[i], FACE_DETECT_MAX_SIDE) for i in indices]
+                batch_boxes, batch_probs = self._mtcnn.detect(det_ims)
+            except Exception as e:
+                logger.error(f"Batched face detection failed: {e}")
+                for i in indices:
+                    results[i] = (pil_ims[i], False, 0.0)
+                continue
+            
+            for i, det_im, boxes, probs in zip(indices, det_ims, batch_boxes, batch_probs):
+                try:
+                    results[i] = self._crop_best(pil_ims[i], boxes, probs, det_im.size)
+                except Exception as e:
+                    logger.error(f"Face detection failed: {e}")
+                    results[i] = (pil_ims[i], False, 0.0)
+        
+        return results
+    
+    def _crop_best(
+        self, pil_im: Image.Image, boxes, probs, det_size: Optional[Tuple[int, int]] = None
+    ) -> Tuple[Image.Image, bool, float]:
+        """
+        Crop the highest-confidence detection out of pil_im.
+        det_size is the (width, height) the boxes were detected at, if not pil_im's.
+        """
+        if boxes is None or len(boxes) == 0:
+            logger.debug("No faces detected in image")
+            return pil_im, False, 0.0
+        
+        # Find the face with highest confidence
+        best_i = int(np.argmax(probs))
+        sx, sy = (pil_im.width / det_size[0], pil_im.height / det_size[1]) if det_size else (1.0, 1.0)
+        bx1, by1, bx2, by2 = boxes[best_i]
+        x1, y1, x2, y2 = int(bx1 * sx), int(by1 * sy), int(bx2 * sx), int(by2 * sy)
+        conf = float(probs[best_i])
+        
+        # Ensure coordinates are within image bounds
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        x2 = min(pil_im.width, x2)
+        y2 = min(pil_im.height, y2)
+        
+        # Validate face region
+        if x2 <= x1 or y2 <= y1:
+            logger.warning("Invalid face coordinates detected")
+            return pil_im, False, 0.0
+        
+        face = pil_im.crop((x1, y1, x2, y2))
+        logger.debug(f"Face detected: confidence={conf:.3f}, size={face.size}")
+        
+        return face, True, conf
 
 # Global instance
 face_detector = FaceDetectorSingleton()
\ No newline at end of file
@@ -1,29 +1,139 @@
+import atexit
 import json
-import math
+import mmap
 import os
-from typing import Dict, List, Tuple, Any
+import stat
+import tempfile
+import threading
+import weakref
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Any
+import numpy as np
+from src.config import FINGERPRINTS_FLUSH_INTERVAL
 from src.utils.logging import setup_logger
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import hnswlib
+except ImportError:  # pragma: no cover - optional speedup
+    hnswlib = None
+
 logger = setup_logger(__name__)
 
+# Below this many families the exact scan is as fast as HNSW and has perfect recall
+HNSW_MIN_FAMILIES = 1000
+HNSW_EF_SEARCH = 64
+# Fingerprint files at least this large are parsed from an mmap
+MMAP_MIN_BYTES = 1 << 20
+
+# Parsed indexes keyed by path
+_index_cache: Dict[str, "AttributionIndex"] = {}
+_index_lock = threading.Lock()
+# Indexes that batch writes, flushed at exit; weak so replaced indexes can be collected
+_batching_indexes: "weakref.WeakSet[AttributionIndex]" = weakref.WeakSet()
+
+def preload_file(path: str) -> bool:
+    """
+    Ask the kernel to start reading a file into the page cache (POSIX_FADV_WILLNEED),
+    so a later load doesn't wait on cold disk reads. No-op where unsupported.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        return True
+    except OSError as e:
+        logger.debug(f"posix_fadvise failed for {path}: {e}")
+        return False
+    finally:
+        os.close(fd)
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _read_json(f) -> Any:
+    """
+    Parse an open binary JSON file. Large files are handed to orjson as a read-only
+    mmap, so the raw bytes are never copied into a Python object.
+    """
+    if orjson is not None and os.fstat(f.fileno()).st_size >= MMAP_MIN_BYTES:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+    return _json_loads(f.read())
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+def _file_mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 class AttributionIndex:
     """Enhanced attribution index with better error handling and persistence"""
     
-    def __init__(self, path: str):
+    def __init__(self, path: Optional[str], flush_interval: float = 0.0, db: Optional[Dict] = None):
+        """
+        flush_interval > 0 batches add_sample writes: updates only mark the database
+        dirty and a timer writes it at most once per interval (and at exit).
+        A given db is used as-is instead of reading path; with path=None the index
+        lives in memory only and is never written.
+        """
         self.path = path
-        self.db = {"version": 1, "families": []}
-        self._load()
+        self.db = db if db is not None else {"version": 1, "families": []}
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        self._mtime: Optional[float] = None
+        self._names: List[str] = []
+        self._feature_keys: List[str] = []
+        self._key_pos: Dict[str, int] = {}
+        self._matrix = np.zeros((0, 0))
+        self._matrix_sq = np.zeros((0, 0))
+        self._present = np.zeros((0, 0))
+        self._packed = np.zeros((0, 0))
+        self._inv_var = np.zeros(0)
+        self._complete = False
+        self._hnsw = None
+        if db is None:
+            self._load()
+        self._build_matrix()
+        self._mtime = _file_mtime(path) if path else None
+        if flush_interval > 0 and path:
+            _batching_indexes.add(self)
+
+    @classmethod
+    def from_dict(cls, db: Dict, path: Optional[str] = None) -> "AttributionIndex":
+        """
+        Build an index from an already-parsed fingerprints database (e.g. a request
+        body or cached copy) without touching disk. If path is given, later updates
+        are saved there.
+        """
+        return cls(path, db=db)
 
     def _load(self):
         """Load fingerprints database with error handling"""
         try:
-            if os.path.exists(self.path):
-                with open(self.path, "r", encoding="utf-8") as f:
-                    self.db = json.load(f)
-                logger.info(f"Loaded {len(self.db.get('families', []))} attribution families")
-            else:
-                logger.warning(f"Fingerprints file not found: {self.path}")
-                self._create_default_db()
+            with open(self.path, "rb") as f:
+                self.db = _read_json(f)
+            logger.info(f"Loaded {len(self.db.get('families', []))} attribution families")
+        except FileNotFoundError:
+            logger.warning(f"Fingerprints file not found: {self.path}")
+            self._create_default_db()
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON in fingerprints file: {e}")
             self._create_default_db()
@@ -76,60 +186,220 @@ class AttributionIndex:
 
     def _save(self):
         """Save fingerprints database"""
+        if not self.path:
+            self._dirty = False
+            return
         try:
-            os.makedirs(os.path.dirname(self.path), exist_ok=True)
-            with open(self.path, "w", encoding="utf-8") as f:
-                json.dump(self.db, f, indent=2)
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                # Never write a stale copy over a file someone else has rewritten
+                # since we loaded it (another worker, maintenance reset)
+                on_disk = _file_mtime(self.path)
+                if self._mtime is not None and on_disk is not None and on_disk != self._mtime:
+                    logger.warning(f"Fingerprints file changed on disk; discarding unsaved updates to {self.path}")
+                    self._dirty = False
+                    return
+                data = _json_dumps(self.db)
+                self._dirty = False
+            # Write a sibling temp file and rename it over the database, so readers
+            # (including live mmaps of the old file) never see a truncated inode
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".fingerprints-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                try:
+                    os.chmod(tmp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+                except FileNotFoundError:
+                    os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            # Our own write shouldn't make get_attribution_index reload us
+            self._mtime = _file_mtime(self.path)
             logger.debug("Fingerprints database saved")
         except Exception as e:
             logger.error(f"Failed to save fingerprints: {e}")
 
+    def _schedule_flush(self):
+        """Mark the database dirty and make sure a flush is pending"""
+        with self._lock:
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        """Write pending add_sample updates to disk"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+            self._save()
+
+    def discard_pending(self):
+        """Cancel a pending flush and drop its updates (the index is being replaced)"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._dirty:
+                logger.warning(f"Discarding unsaved fingerprint updates for reloaded {self.path}")
+                self._dirty = False
+
+    def _build_matrix(self):
+        """
+        Pack family feature means into a (families x features) matrix (SoA layout)
+        over the sorted union of feature keys. Missing features are 0 and tracked in
+        a presence mask so matching keeps per-family common-key semantics.
+        """
+        names, rows = [], []
+        for family in self.db.get("families", []):
+            try:
+                means = {k: float(v) for k, v in family.get("features_mean", {}).items()}
+                names.append(family["name"])
+                rows.append(means)
+            except Exception as e:
+                logger.error(f"Skipping malformed family {family.get('name', 'unknown')}: {e}")
+        
+        keys = sorted(set().union(*rows)) if rows else []
+        key_pos = {k: i for i, k in enumerate(keys)}
+        n_keys = len(keys)
+        # [values | presence | squared values] side by side, so match() needs one GEMM;
+        # the three blocks are views into it rather than separate copies
+        packed = np.zeros((len(rows), 3 * n_keys), dtype=np.float64)
+        matrix = packed[:, :n_keys]
+        present = packed[:, n_keys:2 * n_keys]
+        for i, means in enumerate(rows):
+            for k, v in means.items():
+                matrix[i, key_pos[k]] = v
+                present[i, key_pos[k]] = 1.0
+        np.multiply(matrix, matrix, out=packed[:, 2 * n_keys:])
+        
+        self._names = names
+        self._feature_keys = keys
+        self._key_pos = key_pos
+        self._packed = packed
+        self._matrix = matrix
+        self._present = present
+        self._matrix_sq = packed[:, 2 * n_keys:]
+        # Inverse per-feature variance across the families that have the feature
+        counts = present.sum(axis=0)
+        col_mean = matrix.sum(axis=0) / np.maximum(counts, 1.0)
+        col_var = ((matrix - col_mean) ** 2 * present).sum(axis=0) / np.maximum(counts, 1.0)
+        self._inv_var = 1.0 / np.maximum(col_var, 1e-6)
+        # The approximate index only applies when every family has every feature
+        self._complete = bool(present.all())
+        self._hnsw = None
+
+    def _ann_index(self):
+        """
+        HNSW (cosine) index over the family means, built on first use after a change.
+        Returns None when hnswlib is missing, the DB is small, or families have
+        differing feature sets (the masked exact scan handles those).
+        """
+        if hnswlib is None or len(self._names) < HNSW_MIN_FAMILIES or not self._complete:
+            return None
+        
+        with self._lock:
+            if self._hnsw is None:
+                index = hnswlib.Index(space="cosine", dim=len(self._feature_keys))
+                index.init_index(max_elements=len(self._names), ef_construction=200, M=16)
+                index.add_items(self._matrix.astype(np.float32), np.arange(len(self._names)))
+                index.set_ef(HNSW_EF_SEARCH)
+                self._hnsw = index
+                logger.info(f"Built HNSW index over {len(self._names)} attribution families")
+            return self._hnsw
+
     def all_families(self) -> List[str]:
         """Get all family names"""
         return [f["name"] for f in self.db.get("families", [])]
 
-    def match(self, feats: Dict[str, float], topk: int = 3) -> List[Tuple[str, float]]:
+    def match(
+        self, feats: Dict[str, float], topk: int = 3, metric: str = "cosine"
+    ) -> List[Tuple[str, float]]:
         """
         Match features against known families using cosine similarity.
+        metric="weighted_l2" instead ranks by squared distance with every feature
+        scaled by its inverse variance across families, so large-magnitude
+        features don't dominate; its scores are 1 / (1 + mean scaled distance).
         Returns list of (family_name, similarity_score) tuples.
         """
+        if metric not in ("cosine", "weighted_l2"):
+            raise ValueError(f"Unknown attribution metric: {metric}")
+        
         if not feats:
             logger.warning("No features provided for attribution matching")
             return []
         
-        results = []
+        if not self._names or topk <= 0:
+            return []
         
-        for family in self.db.get("families", []):
-            try:
-                family_features = family.get("features_mean", {})
-                
-                # Find overlapping feature keys
-                common_keys = [k for k in family_features.keys() if k in feats]
-                
-                if not common_keys:
-                    logger.debug(f"No common features with family {family['name']}")
-                    continue
-                
-                # Calculate cosine similarity
-                query_vector = [feats[k] for k in common_keys]
-                family_vector = [family_features[k] for k in common_keys]
-                
-                dot_product = sum(x * y for x, y in zip(query_vector, family_vector))
-                norm_query = math.sqrt(sum(x * x for x in query_vector)) + 1e-8
-                norm_family = math.sqrt(sum(y * y for y in family_vector)) + 1e-8
-                
-                similarity = dot_product / (norm_query * norm_family)
-                results.append((family["name"], float(similarity)))
-                
-            except Exception as e:
-                logger.error(f"Error matching family {family.get('name', 'unknown')}: {e}")
-                continue
+        # Query vector over the packed feature keys, plus a mask of which keys it has
+        q = np.zeros(len(self._feature_keys), dtype=np.float64)
+        q_mask = np.zeros(len(self._feature_keys), dtype=np.float64)
+        for k, v in feats.items():
+            pos = self._key_pos.get(k)
+            if pos is not None:
+                q[pos] = v
+                q_mask[pos] = 1.0
+        
+        # Large DB and the query has every feature: approximate nearest neighbours
+        if metric == "cosine" and topk <= HNSW_EF_SEARCH and q_mask.all():
+            index = self._ann_index()
+            if index is not None:
+                k = min(topk, len(self._names))
+                labels, dists = index.knn_query(q.astype(np.float32)[np.newaxis], k=k)
+                top_results = [
+                    (self._names[i], float(1.0 - d)) for i, d in zip(labels[0], dists[0])
+                ]
+                logger.debug(f"Attribution matching (HNSW): top match: {top_results[0]}")
+                return top_results
+        
+        if metric == "weighted_l2":
+            # Squared differences over the keys both sides have, scaled per feature
+            common = self._present @ q_mask
+            diff_sq = (self._matrix - q) ** 2 * (self._present * q_mask)
+            dist = (diff_sq @ self._inv_var) / np.maximum(common, 1.0)
+            sims = 1.0 / (1.0 + dist)
+        else:
+            # Cosine similarity per family, restricted to the keys both sides have:
+            # zeros in the matrix drop family-missing keys from the dot product, and the
+            # masks restrict each norm to the common keys. The four per-family sums
+            # (dot, query norm, family norm, common count) come from one block product,
+            # which for a short feature vector beats four separate GEMVs on dispatch alone
+            n_keys = len(self._feature_keys)
+            rhs = np.zeros((3 * n_keys, 4), dtype=np.float64)
+            rhs[:n_keys, 0] = q
+            rhs[n_keys:2 * n_keys, 1] = q * q
+            rhs[2 * n_keys:, 2] = q_mask
+            rhs[n_keys:2 * n_keys, 3] = q_mask
+            dot, query_sq, family_sq, common = (self._packed @ rhs).T
+            norm_query = np.sqrt(query_sq) + 1e-8
+            norm_family = np.sqrt(family_sq) + 1e-8
+            sims = dot / (norm_query * norm_family)
+        
+        candidates = np.flatnonzero(common > 0)
+        if len(candidates) == 0:
+            logger.debug("No common features with any family")
+            return []
         
-        # Sort by similarity (highest first) and return top-k
-        results.sort(key=lambda x: x[1], reverse=True)
-        top_results = results[:topk]
+        # Partial selection of the top-k, then sort only those (highest first);
+        # when every candidate is returned the partition pass is pure overhead
+        k = min(topk, len(candidates))
+        cand_sims = sims[candidates]
+        if k < len(candidates):
+            top = np.argpartition(-cand_sims, k - 1)[:k]
+        else:
+            top = np.arange(k)
+        top = top[np.argsort(-cand_sims[top], kind="stable")]
+        top_results = [(self._names[candidates[i]], float(cand_sims[i])) for i in top]
         
-        logger.debug(f"Attribution matching: {len(results)} families, top match: {top_results[0] if top_results else 'none'}")
+        logger.debug(f"Attribution matching: {len(candidates)} families, top match: {top_results[0] if top_results else 'none'}")
         
         return top_results
 
@@ -139,45 +409,104 @@ class AttributionIndex:
         Uses incremental averaging for online learning.
         """
         try:
-            family = None
-            for f in self.db["families"]:
-                if f["name"] == family_name:
-                    family = f
-                    break
+            with self._lock:
+                return self._add_sample(family_name, features)
+        except Exception as e:
+            logger.error(f"Failed to add sample to family {family_name}: {e}")
+            return False
+
+    def _add_sample(self, family_name: str, features: Dict[str, float]) -> bool:
+        family = None
+        for f in self.db["families"]:
+            if f["name"] == family_name:
+                family = f
+                break
+        
+        if family is None:
+            # Create new family
+            family = {
+                "name": family_name,
+                "features_mean": features.copy(),
+                "sample_count": 1,
+                "last_updated": datetime.now().isoformat()
+            }
+            self.db["families"].append(family)
+            logger.info(f"Created new attribution family: {family_name}")
+        else:
+            # Update existing family with incremental averaging
+            n = family.get("sample_count", 0)
+            current_features = family.get("features_mean", {})
             
-            if family is None:
-                # Create new family
-                family = {
-                    "name": family_name,
-                    "features_mean": features.copy(),
-                    "sample_count": 1,
-                    "last_updated": datetime.now().isoformat()
-                }
-                self.db["families"].append(family)
-                logger.info(f"Created new attribution family: {family_name}")
-            else:
-                # Update existing family with incremental averaging
-                n = family.get("sample_count", 0)
-                current_features = family.get("features_mean", {})
+            for key, value in features.items():
+                if key in current_features:
+                    # Incremental average: new_avg = old_avg + (new_value - old_avg) / (n + 1)
+                    current_features[key] += (value - current_features[key]) / (n + 1)
+                else:
+                    current_features[key] = value
+            
+            family["features_mean"] = current_features
+            family["sample_count"] = n + 1
+            family["last_updated"] = datetime.now().isoformat()
+            
+            logger.info(f"Updated attribution family {family_name}: {n + 1} samples")
+        
+        self._build_matrix()
+        if self.flush_interval > 0:
+            self._schedule_flush()
+        else:
+            self._save()
+        return True
+
+    def add_samples_bulk(self, family_name: str, features_list: List[Dict[str, float]]) -> bool:
+        """
+        Add many samples to a family at once: the family mean is merged with the
+        samples' sums in one vectorized step, then the index is rebuilt and saved once.
+        Each feature is averaged over the samples that contain it.
+        """
+        if not features_list:
+            return True
+        
+        try:
+            with self._lock:
+                family = next((f for f in self.db["families"] if f["name"] == family_name), None)
+                old_n = family.get("sample_count", 0) if family is not None else 0
+                old_means = family.get("features_mean", {}) if family is not None else {}
                 
-                for key, value in features.items():
-                    if key in current_features:
-                        # Incremental average: new_avg = old_avg + (new_value - old_avg) / (n + 1)
-                        current_features[key] += (value - current_features[key]) / (n + 1)
-                    else:
-                        current_features[key] = value
+                keys = sorted(set(old_means).union(*features_list))
+                arr = np.array(
+                    [[f.get(k, 0.0) for k in keys] for f in features_list], dtype=np.float64
+                )
+                counts = np.array(
+                    [[k in f for k in keys] for f in features_list], dtype=np.float64
+                ).sum(axis=0)
+                old = np.array([old_means.get(k, 0.0) for k in keys], dtype=np.float64)
+                old_counts = np.array([old_n if k in old_means else 0 for k in keys], dtype=np.float64)
+                total = old_counts + counts
+                # Keys no new sample has (and a family with no recorded samples) keep their mean
+                merged = np.where(
+                    counts > 0, (old * old_counts + arr.sum(axis=0)) / np.maximum(total, 1.0), old
+                )
                 
-                family["features_mean"] = current_features
-                family["sample_count"] = n + 1
+                new_means = dict(zip(keys, merged.tolist()))
+                new_n = old_n + len(features_list)
+                if family is None:
+                    family = {"name": family_name}
+                    self.db["families"].append(family)
+                    logger.info(f"Created new attribution family: {family_name}")
+                family["features_mean"] = new_means
+                family["sample_count"] = new_n
                 family["last_updated"] = datetime.now().isoformat()
+                logger.info(f"Updated attribution family {family_name}: {new_n} samples")
                 
-                logger.info(f"Updated attribution family {family_name}: {n + 1} samples")
-            
-            self._save()
+                self._build_matrix()
+                if self.flush_interval > 0:
+                    self._schedule_flush()
+                else:
+                    self._save()
             return True
-            
+        
         except Exception as e:
-            logger.error(f"Failed to add sample to family {family_name}: {e}")
+            logger.error(f"Failed to add samples to family {family_name}: {e}")
             return False
 
     def get_family_stats(self) -> Dict[str, Any]:
@@ -196,4 +525,34 @@ class AttributionIndex:
                 }
                 for f in families
             ]
-        }
\ No newline at end of file
+        }
+
+def get_attribution_index(path: str) -> AttributionIndex:
+    """
+    Return a shared AttributionIndex for path.
+    The fingerprints file is only re-parsed when its mtime changes.
+    """
+    mtime = _file_mtime(path)
+    cached = _index_cache.get(path)
+    if cached is not None and mtime is not None and cached._mtime == mtime:
+        return cached
+
+    with _index_lock:
+        mtime = _file_mtime(path)
+        cached = _index_cache.get(path)
+        if cached is not None and mtime is not None and cached._mtime == mtime:
+            return cached
+
+        # The file changed under the cached index: its pending writes are stale
+        if cached is not None:
+            cached.discard_pending()
+        idx = AttributionIndex(path, flush_interval=FINGERPRINTS_FLUSH_INTERVAL)
+        _index_cache[path] = idx
+        return idx
+
+def flush_attribution_indexes():
+    """Write pending updates of every write-batching index (called on shutdown and at exit)"""
+    for idx in list(_batching_indexes):
+        idx.flush()
+
+atexit.register(flush_attribution_indexes)
\ No newline at end of file
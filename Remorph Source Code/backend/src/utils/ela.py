@@ -1,24 +1,31 @@
 from io import BytesIO
-from PIL import Image, ImageChops, ImageEnhance
+from PIL import Image, ImageEnhance
 import numpy as np
+import cv2
 
-def error_level_analysis(im: Image.Image, quality: int = 90):
+from src.utils.img import jpeg_roundtrip
+
+def error_level_analysis(im: Image.Image, quality: int = 90, visualize: bool = True):
     """
     Recompresses the image at given JPEG quality and returns ELA image + stats.
-    Works on a copy; returns (ela_image, mean_abs_diff).
+    Works on a copy; returns (ela_image, mean_abs_diff). With visualize=False the
+    brightness-scaled ELA image is not built and None is returned in its place.
     """
-    tmp = BytesIO()
-    im.save(tmp, "JPEG", quality=quality)
-    tmp.seek(0)
-    recompressed = Image.open(tmp)
-    ela_img = ImageChops.difference(im, recompressed)
-    extrema = ela_img.getextrema()
-    # Normalize for visualization
-    scale = 1
-    for channel_extrema in extrema:
-        scale = max(scale, channel_extrema[1])
-    if scale > 0:
-        ela_img = ImageEnhance.Brightness(ela_img).enhance(255.0/scale)
-    arr = np.asarray(ela_img).astype("float32")
-    mean_abs = float(np.mean(np.abs(arr)))
+    arr = np.asarray(im)
+    recompressed = jpeg_roundtrip(arr, quality)
+    if recompressed is None:
+        tmp = BytesIO()
+        im.save(tmp, "JPEG", quality=quality)
+        tmp.seek(0)
+        with Image.open(tmp) as reloaded:
+            recompressed = np.asarray(reloaded)
+    # |a - b| of uint8 views straight over the pixel buffers: exact, no int16 temporaries
+    diff = cv2.absdiff(arr, recompressed)
+    # Visualization stretches the diff so its maximum maps to 255; the statistic
+    # is reported on that scale, which is a linear rescale of the raw mean
+    scale = max(1, int(diff.max()))
+    mean_abs = float(diff.mean()) * (255.0 / scale)
+    if not visualize:
+        return None, mean_abs
+    ela_img = ImageEnhance.Brightness(Image.fromarray(diff)).enhance(255.0/scale)
     return ela_img, mean_abs
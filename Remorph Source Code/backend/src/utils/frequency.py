@@ -1,37 +1,67 @@
+from typing import Tuple, Union
 import numpy as np
 from PIL import Image
 import cv2
 
-def fft_highfreq_ratio(im: Image.Image, frac=0.25):
+try:
+    from scipy.fft import rfft2 as _rfft2
+except ImportError:  # scipy is optional; numpy's pocketfft gives the same result
+    _rfft2 = np.fft.rfft2
+
+def to_gray(im: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    """Return a uint8 grayscale array; arrays are assumed to be grayscale already"""
+    if isinstance(im, np.ndarray):
+        return im
+    return np.asarray(im.convert("L"))
+
+def fft_highfreq_ratio(im: Union[Image.Image, np.ndarray], frac=0.25):
     """
     Returns ratio of high-frequency energy to total energy via 2D FFT on grayscale.
+    Accepts a PIL image or a precomputed uint8 grayscale array.
     """
-    gray = np.array(im.convert("L")).astype("float32") / 255.0
-    f = np.fft.fft2(gray)
-    fshift = np.fft.fftshift(f)
-    mag = np.abs(fshift)
-    h, w = mag.shape
-    cy, cx = h//2, w//2
+    # The ratio is scale-invariant, so the grayscale image is not rescaled to [0,1]
+    gray = to_gray(im).astype(np.float32)
+    # Real-input FFT: only the non-negative column frequencies are computed, the
+    # rest follow from conjugate symmetry (|F(r, w-c)| == |F(-r mod h, c)|)
+    mag = np.abs(_rfft2(gray))
+    h, w = gray.shape
     ry, rx = int(h*frac/2), int(w*frac/2)
-    low = mag[cy-ry:cy+ry, cx-rx:cx+rx].sum()
-    total = mag.sum() + 1e-8
+    # The centred low band of the shifted full spectrum is its four corners: the
+    # left corners are in the half spectrum directly, the right ones mirrored
+    rows = np.r_[0:ry, h-ry:h]
+    low = mag[rows, :rx].sum() + mag[(-rows) % h, 1:rx+1].sum()
+    # Columns 1..ceil(w/2)-1 stand for two columns each; DC (and Nyquist, for even w) once
+    last = w // 2 if w % 2 == 0 else w // 2 + 1
+    total = mag[:, 0].sum() + 2.0 * mag[:, 1:last].sum() + mag[:, last:].sum() + 1e-8
     high = total - low
     return float(high / total)
 
-def laplacian_variance(im: Image.Image):
-    arr = np.array(im.convert("L"))
-    lap = cv2.Laplacian(arr, cv2.CV_64F)
-    return float(lap.var())
+def grayscale_laplacian(im: Union[Image.Image, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (grayscale uint8, Laplacian) for reuse across features and heatmaps.
+    The 3x3 Laplacian of uint8 input fits int16 exactly, so no precision is lost.
+    """
+    gray = to_gray(im)
+    return gray, cv2.Laplacian(gray, cv2.CV_16S)
+
+def variance(arr: np.ndarray) -> float:
+    """Variance of a single-channel array, computed in one pass without a float64 copy"""
+    _, std = cv2.meanStdDev(arr)
+    return float(std[0, 0] ** 2)
+
+def laplacian_variance(im: Union[Image.Image, np.ndarray]):
+    """Variance of the Laplacian; accepts a PIL image or a uint8 grayscale array"""
+    _, lap = grayscale_laplacian(im)
+    return variance(lap)
 
 def jpeg_quant_score(im: Image.Image):
     """
-    Rough proxy for JPEG quantization: recompress at q=95 and compare size delta.
+    Rough proxy for JPEG quantization: encode at q=95 and q=75 and compare sizes.
     """
     import io
-    buf_orig, buf_re = io.BytesIO(), io.BytesIO()
-    im.save(buf_orig, "JPEG", quality=95)
-    re = Image.open(io.BytesIO(buf_orig.getvalue()))
-    re.save(buf_re, "JPEG", quality=75)
-    s1, s2 = len(buf_orig.getvalue()), len(buf_re.getvalue())
+    buf95, buf75 = io.BytesIO(), io.BytesIO()
+    im.save(buf95, "JPEG", quality=95)
+    im.save(buf75, "JPEG", quality=75)
+    s1, s2 = buf95.tell(), buf75.tell()
     if s1 == 0: return 0.0
     return float(s2) / float(s1)
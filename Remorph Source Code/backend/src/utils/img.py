@@ -1,9 +1,86 @@
+import hashlib
 from io import BytesIO
-from PIL import Image, ImageOps
+from typing import Optional
+import cv2
+import numpy as np
+import PIL
+from PIL import Image, ImageOps, features
+
+# Hard cap against decompression bombs; Pillow refuses images beyond 2x this
+Image.MAX_IMAGE_PIXELS = 64_000_000
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover - optional speedup
+    blake3 = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _TJ = TurboJPEG()
+except Exception:  # pragma: no cover - optional speedup, needs the libturbojpeg shared library
+    _TJ = None
+
+def libjpeg_turbo_version() -> Optional[str]:
+    """Version of libjpeg-turbo Pillow is linked against, or None if it uses plain libjpeg"""
+    try:
+        if features.check("libjpeg_turbo"):
+            return features.version("libjpeg_turbo") or "unknown"
+    except Exception:
+        pass
+    return None
+
+def is_pillow_simd() -> bool:
+    """
+    Whether the installed Pillow is the Pillow-SIMD drop-in (versioned X.Y.Z.postN),
+    which has SSE4/AVX2 resize and convert kernels for the downscales done here.
+    """
+    return ".post" in PIL.__version__
+
+def peek_image(data: bytes) -> Image.Image:
+    """Open image lazily: only the header is parsed, so size can be checked before decoding"""
+    return Image.open(BytesIO(data))
+
+def decode_image(im: Image.Image, data: Optional[bytes] = None) -> Image.Image:
+    """
+    Decode a peeked image into RGB pixels. Given the raw bytes, JPEGs are decoded
+    straight to an RGB buffer with PyTurboJPEG when it is installed; metadata (EXIF,
+    ICC profile) is carried over from the peeked image either way.
+    """
+    if _TJ is not None and data is not None and im.format == "JPEG":
+        try:
+            out = Image.fromarray(_TJ.decode(data, pixel_format=TJPF_RGB))
+            out.info = im.info.copy()
+            return out
+        except Exception:
+            pass  # e.g. CMYK or progressive variants turbojpeg rejects; Pillow handles them
+    return im.convert("RGB")
+
+def jpeg_roundtrip(arr: np.ndarray, quality: int) -> Optional[np.ndarray]:
+    """
+    Encode an RGB uint8 array to JPEG and decode it back with PyTurboJPEG, without
+    going through PIL. 4:2:0 subsampling matches Pillow's default JPEG save.
+    Returns None when PyTurboJPEG is unavailable or rejects the input.
+    """
+    if _TJ is None or arr.ndim != 3 or arr.shape[2] != 3:
+        return None
+    try:
+        jpg = _TJ.encode(arr, quality=quality, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+        return _TJ.decode(jpg, pixel_format=TJPF_RGB)
+    except Exception:
+        return None
+
+def content_hash(data: bytes) -> str:
+    """
+    128-bit hash of the raw upload bytes, used to key per-image result caches.
+    Uses BLAKE3 (SIMD, several times faster) when installed, else BLAKE2b; keys
+    are only compared within one process, so either is fine.
+    """
+    if blake3 is not None:
+        return blake3.blake3(data).hexdigest(length=16)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 def load_image_from_bytes(data: bytes) -> Image.Image:
-    im = Image.open(BytesIO(data)).convert("RGB")
-    return im
+    return decode_image(peek_image(data), data)
 
 def to_pil(arr):
     if isinstance(arr, Image.Image):
@@ -16,10 +93,43 @@ def to_pil(arr):
 def save_pil(img: Image.Image, path: str):
     img.save(path)
 
-def ensure_min_size(im, min_side=256):
+def prep_for_encode(im: Image.Image, max_side: int = 512) -> Image.Image:
+    """
+    Downscale so the longer side is at most max_side before JPEG re-encoding
+    statistics (ELA, quantization score). See limit_max_side.
+    """
+    return limit_max_side(im, max_side)
+
+def limit_max_side(im: Image.Image, max_side: int) -> Image.Image:
+    """
+    Downscale (bilinear) so the longer side is at most max_side. Returns im itself
+    if already small enough or max_side <= 0; the original is never modified.
+    """
     w, h = im.size
+    if max_side <= 0 or max(w, h) <= max_side:
+        return im
+    scale = float(max_side) / max(w, h)
+    size = (max(1, round(w*scale)), max(1, round(h*scale)))
+    return im.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+def ensure_min_size(im, min_side=256):
+    """
+    Upscale so the shorter side is at least min_side. Accepts a PIL image or a
+    uint8 ndarray and returns the same type; resizing runs in OpenCV (bicubic).
+    Images keep their metadata (EXIF etc.), as ImageOps.contain does.
+    """
+    is_array = isinstance(im, np.ndarray)
+    h, w = im.shape[:2] if is_array else im.size[::-1]
     if min(w, h) >= min_side:
         return im
     scale = float(min_side) / min(w, h)
     new_w, new_h = int(w*scale), int(h*scale)
-    return ImageOps.contain(im, (new_w, new_h))
+    
+    if is_array:
+        return cv2.resize(im, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    if im.mode not in ("L", "RGB", "RGBA"):
+        return ImageOps.contain(im, (new_w, new_h))
+    resized = cv2.resize(np.asarray(im), (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    out = Image.fromarray(resized)
+    out.info = im.info.copy()
+    return out
@@ -1,16 +1,31 @@
+import gc
+import json
+import sys
+import time
+import types
 import pytest
 import tempfile
 import os
+import weakref
 from PIL import Image
 import numpy as np
 from io import BytesIO
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from src.models.detector import HeuristicDetector, TorchDetector
-from src.trace.attribution import AttributionIndex
-from src.ingest.filtering import accept_image
+from src.models.detector import FEATURE_KEYS, HeuristicDetector, TorchDetector
+from src.trace.attribution import AttributionIndex, flush_attribution_indexes, get_attribution_index
+from src.ingest.filtering import FLAG_LOW_FACE_CONF, FLAG_MIN_SIDE, FLAG_NO_FACE, accept_image, accept_image_batch
 from src.utils.validation import validate_file_upload, sanitize_filename
-from src.utils.img import load_image_from_bytes, ensure_min_size
+from src.utils.img import load_image_from_bytes, ensure_min_size, content_hash
+from src.utils.frequency import grayscale_laplacian, laplacian_variance
+from src.utils.exif_utils import extract_exif_summary
+from src.utils import img as img_utils
 from src.models.face_detector import FaceDetectorSingleton
+from src.api import rate_limiter as rate_limiter_module
+from src.api.rate_limiter import RateLimiter
+from fastapi import HTTPException
+from scripts import maintenance
 
 class TestHeuristicDetector:
     def test_features_extraction(self):
@@ -39,6 +54,69 @@ class TestHeuristicDetector:
         
         score = detector.score(test_features)
         assert 0.0 <= score <= 1.0
+    
+    def test_score_batch(self):
+        """Test vectorized scoring matches per-image scoring"""
+        detector = HeuristicDetector()
+        feats_list = [
+            {"ela_mean": 15.0, "fft_high_ratio": 0.7, "lap_var": 150.0, "jpeg_score": 0.4},
+            {"ela_mean": 2.0, "fft_high_ratio": 0.3, "lap_var": 20.0, "jpeg_score": 0.9},
+            {"ela_mean": 80.0, "fft_high_ratio": 0.9, "lap_var": 5000.0, "jpeg_score": 0.1}
+        ]
+        
+        scores = detector.score_batch(detector.feature_matrix(feats_list))
+        
+        assert scores.shape == (3,)
+        for feats, score in zip(feats_list, scores):
+            assert score == pytest.approx(detector.score(feats))
+    
+    def test_analyze_batch(self):
+        """Test batch analysis matches per-image analysis"""
+        detector = HeuristicDetector()
+        images = [Image.new('RGB', (256, 256), color=c) for c in ('red', 'green', 'blue')]
+        
+        results = detector.analyze_batch(images)
+        
+        assert len(results) == len(images)
+        for im, result in zip(images, results):
+            assert result == detector.analyze(im)
+    
+    def test_features_batch(self):
+        """Test batched features feed score_batch consistently with score"""
+        detector = HeuristicDetector()
+        images = [Image.new('RGB', (256, 256), color=c) for c in ('red', 'green', 'blue')]
+        
+        batch = detector.features_batch(images)
+        
+        for key in FEATURE_KEYS:
+            assert batch[key].shape == (3,)
+        scores = detector.score_batch(np.column_stack([batch[k] for k in FEATURE_KEYS]))
+        for im, score in zip(images, scores):
+            assert score == pytest.approx(detector.analyze(im)["score"])
+    
+    def test_features_cache(self):
+        """Test that features are memoized by content hash"""
+        detector = HeuristicDetector()
+        red = Image.new('RGB', (256, 256), color='red')
+        noise = Image.fromarray(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8))
+        digest = content_hash(b"same upload")
+        
+        first = detector.features(red, content_hash=digest)
+        # Same hash is served from the cache, even for different pixels
+        assert detector.features(noise, content_hash=digest) == first
+        assert detector.features(noise) != first
+    
+    def test_laplacian_variance(self):
+        """Test the int16 Laplacian path against a float reference"""
+        gray = np.random.randint(0, 256, (128, 96), dtype=np.uint8)
+        _, lap = grayscale_laplacian(gray)
+        assert lap.dtype == np.int16
+        
+        # 4-neighbour kernel with OpenCV's default reflect-101 border
+        g = np.pad(gray.astype(np.float64), 1, mode="reflect")
+        ref = g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:] - 4 * g[1:-1, 1:-1]
+        assert np.array_equal(lap, ref)
+        assert laplacian_variance(gray) == pytest.approx(ref.var(), rel=1e-6)
 
 class TestAttributionIndex:
     def test_empty_index(self):
@@ -74,6 +152,181 @@ class TestAttributionIndex:
             assert 0.0 <= matches[0][1] <= 1.0
             
             os.unlink(tmp.name)
+        
+        # Same database, built in memory without a file
+        idx = AttributionIndex.from_dict(test_db)
+        assert idx.match({"fft_high_ratio": 0.65, "ela_mean": 12.0}, topk=1) == matches
+        idx.add_sample("test_family", {"fft_high_ratio": 0.7})
+        assert idx.path is None
+    
+    def test_weighted_l2_match(self):
+        """Test that variance-scaled matching is not dominated by large-magnitude features"""
+        idx = AttributionIndex.from_dict({
+            "version": 1,
+            "families": [
+                {"name": "sharp", "features_mean": {"fft_high_ratio": 0.9, "lap_var": 100.0}},
+                {"name": "smooth", "features_mean": {"fft_high_ratio": 0.1, "lap_var": 130.0}}
+            ]
+        })
+        query = {"fft_high_ratio": 0.85, "lap_var": 125.0}
+        
+        matches = idx.match(query, topk=2, metric="weighted_l2")
+        
+        assert [name for name, _ in matches] == ["sharp", "smooth"]
+        assert all(0.0 < score <= 1.0 for _, score in matches)
+        with pytest.raises(ValueError):
+            idx.match(query, metric="unknown")
+    
+    def test_cached_index_reuse(self):
+        """Test that the shared index is only reloaded when the file changes"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fingerprints.json")
+            idx1 = get_attribution_index(path)
+            idx2 = get_attribution_index(path)
+            assert idx1 is idx2
+            
+            mtime = os.stat(path).st_mtime + 10
+            os.utime(path, (mtime, mtime))
+            idx3 = get_attribution_index(path)
+            assert idx3 is not idx1
+            assert idx3.all_families() == idx1.all_families()
+            
+            # Reloading must not keep the replaced index alive
+            ref = weakref.ref(idx1)
+            del idx1, idx2
+            gc.collect()
+            assert ref() is None
+    
+    def test_batched_writes(self):
+        """Test that add_sample defers writes until flush when batching is enabled"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fingerprints.json")
+            idx = AttributionIndex(path, flush_interval=60.0)
+            assert idx.add_sample("new_family", {"ela_mean": 10.0})
+            assert "new_family" not in AttributionIndex(path).all_families()
+            
+            idx.flush()
+            assert "new_family" in AttributionIndex(path).all_families()
+    
+    def test_pending_flush_after_external_rewrite(self):
+        """Test that a pending flush never overwrites a newer file written by someone else"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fingerprints.json")
+            
+            def rewrite_externally():
+                with open(path, "w") as f:
+                    json.dump({"version": 1, "families": [{"name": "external", "features_mean": {}}]}, f)
+                mtime = os.stat(path).st_mtime + 10
+                os.utime(path, (mtime, mtime))
+            
+            # Directly held batching index
+            idx = AttributionIndex(path, flush_interval=60.0)
+            idx.add_sample("stale_family", {"ela_mean": 10.0})
+            rewrite_externally()
+            idx.flush()
+            assert AttributionIndex(path).all_families() == ["external"]
+            
+            # Shared index replaced on reload: its timer is cancelled, exit flush is a no-op
+            shared = get_attribution_index(path)
+            shared.add_sample("stale_family", {"ela_mean": 10.0})
+            assert shared._flush_timer is not None
+            rewrite_externally()
+            assert get_attribution_index(path) is not shared
+            assert shared._flush_timer is None
+            flush_attribution_indexes()
+            assert AttributionIndex(path).all_families() == ["external"]
+    
+    def test_save_replaces_file(self):
+        """Test that saves swap in a new file instead of rewriting the one readers may map"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fingerprints.json")
+            idx = AttributionIndex(path)
+            with open(path, "rb") as reader:
+                before = reader.read()
+                idx.add_sample("new_family", {"ela_mean": 10.0})
+                reader.seek(0)
+                assert reader.read() == before
+            
+            assert "new_family" in AttributionIndex(path).all_families()
+            assert os.listdir(tmpdir) == ["fingerprints.json"]
+    
+    def test_bulk_samples_match_incremental(self):
+        """Test that add_samples_bulk gives the same means as repeated add_sample"""
+        samples = [{"ela_mean": float(i), "lap_var": 100.0 + i} for i in range(10)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            incremental = AttributionIndex(os.path.join(tmpdir, "a.json"))
+            for feats in samples:
+                incremental.add_sample("bulk_family", feats)
+            bulk = AttributionIndex(os.path.join(tmpdir, "b.json"))
+            assert bulk.add_samples_bulk("bulk_family", samples)
+            
+            expected = next(f for f in incremental.db["families"] if f["name"] == "bulk_family")
+            actual = next(f for f in bulk.db["families"] if f["name"] == "bulk_family")
+            assert actual["sample_count"] == expected["sample_count"]
+            for key, value in expected["features_mean"].items():
+                assert actual["features_mean"][key] == pytest.approx(value)
+    
+    def test_hnsw_matches_exact_scan(self, monkeypatch):
+        """Test that the HNSW path returns the same top match as the exact scan"""
+        pytest.importorskip("hnswlib")
+        import json
+        import src.trace.attribution as attribution
+        monkeypatch.setattr(attribution, "HNSW_MIN_FAMILIES", 10)
+        
+        rng = np.random.default_rng(0)
+        keys = ["ela_mean", "fft_high_ratio", "jpeg_score", "lap_var"]
+        families = [
+            {"name": f"family_{i}", "features_mean": dict(zip(keys, rng.uniform(0, 100, 4).tolist()))}
+            for i in range(50)
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fingerprints.json")
+            with open(path, "w") as f:
+                json.dump({"version": 1, "families": families}, f)
+            
+            idx = AttributionIndex(path)
+            query = dict(zip(keys, rng.uniform(0, 100, 4).tolist()))
+            approx = idx.match(query, topk=1)
+            assert idx._hnsw is not None
+            
+            idx._complete = False
+            exact = idx.match(query, topk=1)
+            assert approx[0][0] == exact[0][0]
+            assert approx[0][1] == pytest.approx(exact[0][1], abs=1e-5)
+
+class TestTorchDetector:
+    def test_concurrent_gradcam(self, monkeypatch):
+        """Test that Grad-CAM calls on the shared model don't interleave"""
+        active, overlaps = [0], []
+        
+        class FakeTensor:
+            def unsqueeze(self, dim): return self
+            def to(self, device): return self
+            def requires_grad_(self, flag): return self
+        
+        class FakeGradCAM:
+            def __init__(self, model, layer):
+                active[0] += 1
+                overlaps.append(active[0] > 1)
+            
+            def generate(self, x, class_idx=None):
+                time.sleep(0.01)
+                active[0] -= 1
+                return types.SimpleNamespace(numpy=lambda: np.zeros((7, 7), dtype=np.float32))
+        
+        monkeypatch.setitem(sys.modules, "src.models.gradcam", types.SimpleNamespace(GradCAM=FakeGradCAM))
+        detector = TorchDetector("nonexistent_weights.pt", device="cpu", target_layer="layer4")
+        detector.available, detector.model = True, object()
+        detector.transform = lambda im: FakeTensor()
+        detector._layer_names = frozenset({"layer4"})
+        
+        im = Image.new('RGB', (64, 64))
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            cams = list(pool.map(lambda _: detector.gradcam(im), range(8)))
+        
+        assert all(cam is not None and cam.shape == (7, 7) for cam in cams)
+        assert not any(overlaps)
+        assert detector.gradcam(im, target_layer="no.such.layer") is None
 
 class TestValidation:
     def test_filename_sanitization(self):
@@ -105,6 +358,102 @@ class TestValidation:
         with pytest.raises(Exception):
             validate_file_upload("test.jpg", 20 * 1024 * 1024)
 
+    def test_upload_size_limit_middleware(self):
+        """Test that oversized uploads get 413 before reaching the route"""
+        pytest.importorskip("httpx")
+        from fastapi import FastAPI, File, UploadFile
+        from fastapi.testclient import TestClient
+        from src.api.middleware import UploadSizeLimitMiddleware
+        
+        app = FastAPI()
+        reached = []
+        
+        @app.post("/upload")
+        async def upload(file: UploadFile = File(...)):
+            reached.append(file.filename)
+            return {"size": len(await file.read())}
+        
+        app.add_middleware(UploadSizeLimitMiddleware, limits={"/upload": 2048})
+        client = TestClient(app)
+        
+        response = client.post("/upload", files={"file": ("small.jpg", b"x" * 100)})
+        assert response.status_code == 200
+        assert response.json() == {"size": 100}
+        
+        response = client.post("/upload", files={"file": ("big.jpg", b"x" * 4096)})
+        assert response.status_code == 413
+        assert "File too large" in response.json()["detail"]
+        assert reached == ["small.jpg"]
+
+class TestRateLimiter:
+    @staticmethod
+    def _request(host):
+        return types.SimpleNamespace(headers={}, client=types.SimpleNamespace(host=host))
+    
+    def test_limit_and_window_reset(self, monkeypatch):
+        """Test that requests over the limit get 429 until the window expires"""
+        now = [1000.0]
+        monkeypatch.setattr(rate_limiter_module.time, "monotonic", lambda: now[0])
+        limiter = RateLimiter(max_requests=3, window_seconds=60)
+        
+        for _ in range(3):
+            assert limiter.check_rate_limit(self._request("1.2.3.4"))
+        with pytest.raises(HTTPException) as exc:
+            limiter.check_rate_limit(self._request("1.2.3.4"))
+        assert exc.value.status_code == 429
+        # Other clients have their own window
+        assert limiter.check_rate_limit(self._request("5.6.7.8"))
+        
+        now[0] += 60
+        assert limiter.check_rate_limit(self._request("1.2.3.4"))
+        assert limiter.clients["1.2.3.4"] == (1, 1060.0)
+    
+    def test_lru_eviction(self):
+        """Test that the least recently seen client is evicted beyond max_clients"""
+        limiter = RateLimiter(max_requests=10, window_seconds=60, max_clients=2)
+        limiter.check_rate_limit(self._request("a"))
+        limiter.check_rate_limit(self._request("b"))
+        limiter.check_rate_limit(self._request("a"))
+        limiter.check_rate_limit(self._request("c"))
+        assert list(limiter.clients) == ["a", "c"]
+    
+    def test_concurrent_requests_counted(self):
+        """Test that concurrent checks neither lose counts nor raise on eviction"""
+        limiter = RateLimiter(max_requests=10000, window_seconds=60, max_clients=4)
+        hosts = [f"10.0.0.{i % 8}" for i in range(4000)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert all(pool.map(lambda host: limiter.check_rate_limit(self._request(host)), hosts))
+        
+        limiter = RateLimiter(max_requests=10000, window_seconds=60)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: limiter.check_rate_limit(self._request("1.1.1.1")), range(2000)))
+        assert limiter.clients["1.1.1.1"][0] == 2000
+
+class TestMaintenance:
+    def test_cleanup_old_outputs(self, tmp_path, monkeypatch):
+        """Test that cleanup removes old flat files and day directories, and dry-run keeps all"""
+        monkeypatch.setattr(maintenance, "OUTPUT_DIR", str(tmp_path))
+        today = datetime.now(timezone.utc)
+        old_day = (today - timedelta(days=30)).strftime("%Y%m%d")
+        new_day = today.strftime("%Y%m%d")
+        old_mtime = time.time() - 30 * 24 * 3600
+        
+        for day in (old_day, new_day):
+            (tmp_path / day).mkdir()
+            (tmp_path / day / "heat_x.png").write_bytes(b"x")
+        (tmp_path / "keep_me").mkdir()  # not a day directory
+        (tmp_path / "old.png").write_bytes(b"x")
+        os.utime(tmp_path / "old.png", (old_mtime, old_mtime))
+        (tmp_path / "new.png").write_bytes(b"x")
+        
+        before = sorted(os.listdir(tmp_path))
+        assert maintenance.cleanup_old_outputs(days_old=7, dry_run=True) == (1, 1)
+        assert sorted(os.listdir(tmp_path)) == before
+        
+        assert maintenance.cleanup_old_outputs(days_old=7) == (1, 1)
+        assert sorted(os.listdir(tmp_path)) == sorted([new_day, "keep_me", "new.png"])
+        assert (tmp_path / new_day / "heat_x.png").exists()
+
 class TestImageProcessing:
     def test_image_loading(self):
         """Test image loading from bytes"""
@@ -117,12 +466,44 @@ class TestImageProcessing:
         assert loaded.mode == 'RGB'
         assert loaded.size == (100, 100)
     
+    def test_decode_keeps_exif(self, monkeypatch):
+        """Test that decoding keeps EXIF on both the Pillow and the TurboJPEG path"""
+        exif = Image.Exif()
+        exif[0x010F] = "TestMake"
+        exif[0x0110] = "TestModel"
+        buf = BytesIO()
+        Image.new('RGB', (100, 100), color='blue').save(buf, format='JPEG', exif=exif)
+        data = buf.getvalue()
+        
+        class FakeTurboJPEG:
+            calls = 0
+            def decode(self, data, pixel_format=None):
+                FakeTurboJPEG.calls += 1
+                return np.asarray(Image.open(BytesIO(data)).convert("RGB"))
+        
+        monkeypatch.setattr(img_utils, "TJPF_RGB", 0, raising=False)
+        for tj in (None, FakeTurboJPEG()):
+            monkeypatch.setattr(img_utils, "_TJ", tj)
+            summary = extract_exif_summary(load_image_from_bytes(data))
+            assert summary.get("Make") == "TestMake"
+            assert summary.get("Model") == "TestModel"
+        assert FakeTurboJPEG.calls == 1
+    
     def test_ensure_min_size(self):
         """Test minimum size enforcement"""
         small_img = Image.new('RGB', (50, 50), color='green')
         resized = ensure_min_size(small_img, min_side=100)
         
         assert min(resized.size) >= 100
+        
+        # Upscaled uploads keep their EXIF (read by /analyze after resizing)
+        exif = Image.Exif()
+        exif[0x010F] = "TestMake"
+        buf = BytesIO()
+        Image.new('RGB', (240, 240), color='green').save(buf, format='JPEG', exif=exif)
+        resized = ensure_min_size(load_image_from_bytes(buf.getvalue()), min_side=256)
+        assert resized.size == (256, 256)
+        assert extract_exif_summary(resized).get("Make") == "TestMake"
 
 class TestQualityFiltering:
     def test_accept_image_logic(self):
@@ -146,6 +527,16 @@ class TestQualityFiltering:
         accept, flags = accept_image(True, 0.95, 100, 100)
         assert accept is False
         assert any("min_side" in note for note in flags.notes)
+    
+    def test_accept_image_batch(self):
+        """Test vectorized acceptance agrees with accept_image"""
+        cases = [(True, 0.95, 512, 512), (True, 0.5, 512, 512), (False, 0.0, 512, 512), (True, 0.95, 100, 100)]
+        found, conf, width, height = (np.array(col) for col in zip(*cases))
+        
+        accept, flags = accept_image_batch(found, conf, width, height)
+        
+        assert accept.tolist() == [accept_image(*case)[0] for case in cases]
+        assert flags.tolist() == [0, FLAG_LOW_FACE_CONF, FLAG_NO_FACE, FLAG_MIN_SIDE]
 
 class TestFaceDetector:
     def test_singleton_pattern(self):
@@ -166,6 +557,17 @@ class TestFaceDetector:
         assert isinstance(found, bool)
         assert isinstance(conf, float)
         assert 0.0 <= conf <= 1.0
+    
+    def test_crop_maps_boxes_per_axis(self):
+        """Test that boxes found on a downscaled copy map back with separate x/y ratios"""
+        detector = FaceDetectorSingleton()
+        im = Image.new('RGB', (3000, 1000))
+        boxes, probs = np.array([[100.0, 50.0, 300.0, 150.0]]), np.array([0.99])
+        
+        crop, found, conf = detector._crop_best(im, boxes, probs, det_size=(1000, 500))
+        assert found and conf == pytest.approx(0.99)
+        assert crop.size == (600, 200)
+        assert detector._crop_best(im, boxes, probs)[0].size == (200, 100)
 
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
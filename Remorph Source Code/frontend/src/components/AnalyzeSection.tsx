@@ -352,7 +352,7 @@ const AnalyzeSection: React.FC = () => {
                     <span>View</span>
                   </button>
                   <button
-                    onClick={() => downloadImage(result.files.overlay_url, `overlay_${result.id}.png`)}
+                    onClick={() => downloadImage(result.files.overlay_url, `overlay_${result.id}.jpg`)}
                     className="btn-secondary flex-1 flex items-center justify-center space-x-2"
                   >
                     <Download className="w-4 h-4" />
@@ -15,7 +15,10 @@ const ImageViewer: React.FC<ImageViewerProps> = ({ imageUrl, title, onClose }) =
       const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
       link.href = url;
-      link.download = `${title.toLowerCase().replace(/\s+/g, '_')}.png`;
+      // Keep the served format's extension (overlays are JPEG, heatmaps PNG)
+      const { pathname } = new URL(imageUrl, window.location.href);
+      const extension = pathname.match(/\.[a-z0-9]+$/i)?.[0] ?? '.png';
+      link.download = `${title.toLowerCase().replace(/\s+/g, '_')}${extension}`;
       document.body.appendChild(link);
       link.click();
       document.body.removeChild(link);